@@ -0,0 +1,85 @@
+from decouple import config
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+# Number of most recent movement ids kept on each balance to recognize retried movements
+APPLIED_MOVEMENTS_LIMIT = config("APPLIED_MOVEMENTS_LIMIT", default=1000, cast=int)
+
+
+def available_at_least(qty: int) -> dict:
+    """Filter matching balances whose available quantity, qty - reserved, is at least `qty`"""
+    return {'$expr': {'$gte': [{'$subtract': ['$qty', {'$ifNull': ['$reserved', 0]}]}, qty]}}
+
+
+def reserved_at_most(qty: int) -> dict:
+    """Filter matching balances whose reserved quantity would still be covered by a qty of `qty`"""
+    return {'$expr': {'$lte': [{'$ifNull': ['$reserved', 0]}, qty]}}
+
+
+class BalanceNotFoundError(Exception):
+    """Raised when decreasing the qty of a balance that does not exist."""
+
+
+class InsufficientQtyError(Exception):
+    """Raised when a decrease is larger than the available qty of a balance."""
+
+
+def adjust(balance_collection, product_id: str, location_id: str, qty_change: int, movement_id: str = None,
+           reserved_change: int = 0) -> tuple:
+    """Changes the qty of a balance by `qty_change` in a single conditional update, returns the qty before and
+    after the change, whether it was applied and the reorder point of the balance, read in the same update.
+
+    A decrease only applies if the available qty, qty - reserved, covers it once the reserved qty is changed by
+    `reserved_change` too, as a reservation commit does. An increase creates the balance if it does not exist yet.
+    As the change is relative, concurrent adjustments and reservation commits of the same balance never overwrite
+    each other.
+
+    With a `movement_id` the id is recorded on the balance in the same update, and a change carrying an id that
+    was already applied is skipped. A movement retried after a timeout is therefore never applied twice.
+
+    A balance is created with an `_id` made of its product and location ids rather than by an upsert, so retried
+    or concurrent creations collide on `_id` even before the unique (product_id, location_id) index exists.
+    """
+    filters = {'product_id': product_id, 'location_id': location_id}
+    projection = {'qty': 1, 'reorder_point': 1}
+    guard = {}
+    update = {'$inc': {'qty': qty_change}}
+    if reserved_change:
+        update['$inc']['reserved'] = reserved_change
+
+    if movement_id:
+        guard = {'applied_movements': {'$ne': movement_id}}
+        update['$push'] = {'applied_movements': {'$each': [movement_id], '$slice': -APPLIED_MOVEMENTS_LIMIT}}
+
+    if qty_change < 0:
+        available = available_at_least(reserved_change - qty_change)
+        doc = balance_collection.find_one_and_update({**filters, **guard, **available}, update, projection,
+                                                     return_document=ReturnDocument.AFTER)
+    else:
+        doc = balance_collection.find_one_and_update({**filters, **guard}, update, projection,
+                                                     return_document=ReturnDocument.AFTER)
+
+        if not doc and not balance_collection.find_one(filters, {'_id': 1}):
+            balance = {'_id': dict(filters), **filters, 'qty': qty_change}
+            if movement_id:
+                balance['applied_movements'] = [movement_id]
+
+            try:
+                balance_collection.insert_one(balance)
+                return 0, qty_change, True, None
+            except DuplicateKeyError:
+                # Another adjustment, or an earlier attempt of this movement, created the balance in the meantime
+                doc = balance_collection.find_one_and_update({**filters, **guard}, update, projection,
+                                                             return_document=ReturnDocument.AFTER)
+
+    if doc:
+        return doc['qty'] - qty_change, doc['qty'], True, doc.get('reorder_point')
+
+    if movement_id:
+        applied = balance_collection.find_one({**filters, 'applied_movements': movement_id}, projection)
+        if applied:
+            return applied['qty'], applied['qty'], False, applied.get('reorder_point')
+
+    if not balance_collection.find_one(filters, {'_id': 1}):
+        raise BalanceNotFoundError(f"Record with {product_id} and {location_id} does not exist.")
+    raise InsufficientQtyError(f"Not enough available qty of {product_id} at {location_id}.")
@@ -0,0 +1,100 @@
+"""Benchmarks response compression of balance listings.
+
+Builds a synthetic GET response with the same shape as the balance listing and compresses it with gzip and,
+if the zstandard package is installed, zstd at several levels. Reports the compressed size, CPU time spent
+compressing and decompressing, and the time to send the body over a link of the given bandwidth, to help pick
+COMPRESSION_GZIP_LEVEL / COMPRESSION_ZSTD_LEVEL for clients far away.
+
+Usage: python benchmark_compression.py [--rows 200000] [--bandwidth-mbps 100] [--repeat 3]
+"""
+import argparse
+import json
+import random
+import time
+import zlib
+
+from bson import ObjectId
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+def synthetic_payload(rows: int) -> bytes:
+    rng = random.Random(42)
+    products = [str(ObjectId()) for _ in range(max(1, rows // 20))]
+    locations = [str(ObjectId()) for _ in range(50)]
+
+    data = [{
+        '_id': {'$oid': str(ObjectId())},
+        'product_id': rng.choice(products),
+        'location_id': rng.choice(locations),
+        'qty': rng.randint(0, 5000),
+    } for _ in range(rows)]
+
+    return json.dumps({
+        "status": 200,
+        "message": "Success",
+        "timestamp": "2022-06-03T10:00:00",
+        "data": data,
+        "records_count": rows
+    }).encode()
+
+
+def codecs():
+    for level in (1, 6, 9):
+        yield (f"gzip-{level}",
+               lambda body, level=level: zlib.compress(body, level, 31),
+               lambda body: zlib.decompress(body, 31))
+
+    if zstandard:
+        for level in (1, 3, 9):
+            yield (f"zstd-{level}",
+                   lambda body, level=level: zstandard.ZstdCompressor(level=level).compress(body),
+                   lambda body: zstandard.ZstdDecompressor().decompress(body))
+
+
+def timed(func, body: bytes, repeat: int):
+    best, result = None, None
+    for _ in range(repeat):
+        started = time.process_time()
+        result = func(body)
+        elapsed = time.process_time() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=200000)
+    parser.add_argument('--bandwidth-mbps', type=float, default=100.0)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    body = synthetic_payload(args.rows)
+    bytes_per_second = args.bandwidth_mbps * 1000 * 1000 / 8
+
+    print(f"payload: {len(body) / 1e6:.1f} MB, {args.rows} rows, link: {args.bandwidth_mbps} Mbit/s")
+    print(f"{'codec':<10}{'size MB':>10}{'ratio':>8}{'compress ms':>14}{'decompress ms':>16}{'send ms':>10}"
+          f"{'total ms':>10}")
+    print(f"{'identity':<10}{len(body) / 1e6:>10.2f}{1:>8.1f}{0:>14.1f}{0:>16.1f}"
+          f"{len(body) / bytes_per_second * 1000:>10.1f}{len(body) / bytes_per_second * 1000:>10.1f}")
+
+    if not zstandard:
+        print("zstandard is not installed, zstd is skipped")
+
+    for name, compress, decompress in codecs():
+        compress_time, compressed = timed(compress, body, args.repeat)
+        decompress_time, restored = timed(decompress, compressed, args.repeat)
+        assert restored == body
+
+        send_time = len(compressed) / bytes_per_second
+        total = compress_time + send_time + decompress_time
+        print(f"{name:<10}{len(compressed) / 1e6:>10.2f}{len(body) / len(compressed):>8.1f}"
+              f"{compress_time * 1000:>14.1f}{decompress_time * 1000:>16.1f}{send_time * 1000:>10.1f}"
+              f"{total * 1000:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""Benchmarks concurrent reservations against hot SKUs.
+
+Creates a few balances in a separate benchmark database on the cluster configured by DB_CONNECTION_STRING,
+then lets many threads reserve from them at once. Reports reservations per second and verifies that no
+balance was oversold: the number of successful reservations must equal the stock and the reserved qty must
+match the sum of the holds.
+
+Usage: python benchmark_reservations.py [--threads 64] [--skus 4] [--stock 20000] [--qty 1]
+"""
+import argparse
+import threading
+import time
+
+import pymongo
+from decouple import config
+
+import reservations
+
+BENCHMARK_DB_NAME = config("BENCHMARK_DB_NAME", default="balance_benchmark")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--threads', type=int, default=64)
+    parser.add_argument('--skus', type=int, default=4, help="number of hot balances the threads contend on")
+    parser.add_argument('--stock', type=int, default=20000, help="initial qty of each balance")
+    parser.add_argument('--qty', type=int, default=1, help="qty held by each reservation")
+    args = parser.parse_args()
+
+    client = pymongo.MongoClient(config("DB_CONNECTION_STRING"), maxPoolSize=args.threads)
+    db = client[BENCHMARK_DB_NAME]
+    balance_collection = db["balance"]
+    reservations_collection = db["reservations"]
+
+    balance_collection.drop()
+    reservations_collection.drop()
+    reservations.ensure_indexes(balance_collection, reservations_collection)
+    balance_collection.insert_many([
+        {'product_id': f'hot-{sku}', 'location_id': 'benchmark', 'qty': args.stock} for sku in range(args.skus)
+    ])
+
+    succeeded = [0] * args.threads
+    rejected = [0] * args.threads
+
+    def worker(index: int) -> None:
+        product_id = f'hot-{index % args.skus}'
+        while True:
+            try:
+                reservations.reserve(balance_collection, reservations_collection, product_id, 'benchmark',
+                                     args.qty)
+                succeeded[index] += 1
+            except reservations.InsufficientStockError:
+                rejected[index] += 1
+                return
+
+    threads = [threading.Thread(target=worker, args=(index,)) for index in range(args.threads)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    total = sum(succeeded)
+    print(f"{total} reservations by {args.threads} threads on {args.skus} SKUs in {elapsed:.2f}s "
+          f"({total / elapsed:.0f} reservations/s), {sum(rejected)} rejected once stock ran out")
+
+    # Worker threads are spread over the SKUs, with fewer threads than SKUs some are never reserved from
+    expected = min(args.skus, args.threads) * (args.stock // args.qty)
+    reserved = sum(doc.get('reserved', 0) for doc in balance_collection.find())
+    held = sum(doc['qty'] for doc in reservations_collection.find())
+    oversold = balance_collection.count_documents({'$expr': {'$gt': [{'$ifNull': ['$reserved', 0]}, '$qty']}})
+
+    print(f"expected reservations: {expected}, reserved qty: {reserved}, held qty: {held}, oversold SKUs: {oversold}")
+    if total != expected or reserved != held or oversold:
+        raise SystemExit("Consistency check failed.")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,134 @@
+import logging
+import socket
+import threading
+from datetime import datetime
+
 import pymongo
-from decouple import config
+from decouple import Choices, config
+from pymongo import monitoring
+from pymongo.write_concern import WriteConcern
+
+DB_MAX_POOL_SIZE = config("DB_MAX_POOL_SIZE", default=100, cast=int)
+DB_MIN_POOL_SIZE = config("DB_MIN_POOL_SIZE", default=0, cast=int)
+DB_DURABILITY_PROFILE = config("DB_DURABILITY_PROFILE", default="default",
+                               cast=Choices(['default', 'fast', 'strict']))
+DB_WRITE_TIMEOUT_MS = config("DB_WRITE_TIMEOUT_MS", default=5000, cast=int)
+DB_JOURNAL_FLUSH_INTERVAL_MS = config("DB_JOURNAL_FLUSH_INTERVAL_MS", default=100, cast=int)
+
+# Write concern of each durability profile:
+# - default: the write concern of the connection string, or the server default
+# - fast: acknowledged by the primary before it is journaled, a background flush journals writes in batches
+# - strict: acknowledged once journaled by a majority of the replica set
+WRITE_CONCERNS = {
+    'default': None,
+    'fast': WriteConcern(w=1, j=False),
+    'strict': WriteConcern(w='majority', j=True, wtimeout=DB_WRITE_TIMEOUT_MS),
+}
+write_concern = WRITE_CONCERNS[DB_DURABILITY_PROFILE]
+
+JOURNAL_FLUSH_COLLECTION = 'journal_flush'
+WRITE_COMMANDS = ('insert', 'update', 'delete', 'findAndModify')
+
+
+class WriteListener(monitoring.CommandListener):
+    """Notes that the client sent writes since the last journal flush, the flush writes themselves do not count"""
+
+    def __init__(self):
+        self.pending = threading.Event()
 
-client = pymongo.MongoClient(config("DB_CONNECTION_STRING"))
-db = client["balance"]
+    def started(self, event):
+        if event.command_name in WRITE_COMMANDS and event.command.get(event.command_name) != JOURNAL_FLUSH_COLLECTION:
+            self.pending.set()
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+write_listener = WriteListener()
+
+# Bound how long an operation waits for a reachable server so health checks fail fast while the database is down
+client = pymongo.MongoClient(config("DB_CONNECTION_STRING"),
+                             serverSelectionTimeoutMS=config("DB_SERVER_SELECTION_TIMEOUT_MS", default=5000, cast=int),
+                             maxPoolSize=DB_MAX_POOL_SIZE, minPoolSize=DB_MIN_POOL_SIZE,
+                             event_listeners=[write_listener] if DB_DURABILITY_PROFILE == 'fast' else [])
+db = client.get_database("balance", write_concern=write_concern)
 collection = db["balance"]
+reservations_collection = db["reservations"]
+
+# Committed reservations are recorded as movements in the movement service database on the same cluster
+movements_db = client.get_database("movements", write_concern=write_concern)
+movements_collection = movements_db["movements"]
+movement_status_collection = movements_db["movement_status"]
+
+
+def ping_database() -> bool:
+    """Checks if the database is reachable"""
+    try:
+        client.admin.command('ping')
+        return True
+    except pymongo.errors.PyMongoError:
+        return False
+
+
+def database_profile() -> dict:
+    """Describes the active durability profile and pool limits, reported by the readiness endpoint"""
+    return {
+        'durability_profile': DB_DURABILITY_PROFILE,
+        'write_concern': db.write_concern.document,
+        'max_pool_size': DB_MAX_POOL_SIZE,
+        'min_pool_size': DB_MIN_POOL_SIZE,
+    }
+
+
+class JournalFlusher(threading.Thread):
+    """Background thread bounding the writes the fast profile loses if the primary crashes before journaling them.
+
+    A journaled write commits the journal of the primary up to that write, including every write of every
+    database that came before it, so at most DB_JOURNAL_FLUSH_INTERVAL_MS of acknowledged writes are at risk.
+    An interval without writes seen by `listener` is skipped, so an idle service adds no journal or oplog entries.
+    """
+
+    def __init__(self, database=db, interval_ms: int = DB_JOURNAL_FLUSH_INTERVAL_MS, listener=write_listener):
+        super().__init__(daemon=True)
+        self.interval = interval_ms / 1000
+        self.listener = listener
+        self.flush_collection = database.get_collection(JOURNAL_FLUSH_COLLECTION,
+                                                        write_concern=WriteConcern(w=1, j=True))
+        self.failing = False
+        self.stopped = threading.Event()
+
+    def flush(self) -> None:
+        self.flush_collection.update_one({'_id': socket.gethostname()},
+                                         {'$set': {'flushed_at': datetime.utcnow()}}, upsert=True)
+
+    def stop(self) -> None:
+        self.stopped.set()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            if not self.listener.pending.is_set():
+                continue
+
+            # Cleared before flushing, a write sent during the flush is covered by the next one
+            self.listener.pending.clear()
+            try:
+                self.flush()
+                self.failing = False
+            except pymongo.errors.PyMongoError as error:
+                self.listener.pending.set()
+                # Log once per outage instead of on every interval
+                if not self.failing:
+                    logging.warning(f"Journal flush failed: {error}")
+                self.failing = True
+
+
+def start_journal_flusher() -> None:
+    """Starts the background journal flush when the fast durability profile is active"""
+    if DB_DURABILITY_PROFILE != 'fast':
+        return
+
+    JournalFlusher().start()
+    logging.info(f"Fast durability profile enabled, journal flushed every {DB_JOURNAL_FLUSH_INTERVAL_MS}ms.")
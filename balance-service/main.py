@@ -2,11 +2,16 @@ import json
 import logging
 from datetime import datetime
 
-from bson import json_util
+from bson import json_util, ObjectId
 from flask import Flask, request
 from flask_restful import Api, Resource
+from pymongo.errors import DuplicateKeyError
 
-from database_connector import collection
+import adjustments
+import reservations
+from compression import init_compression
+from database_connector import collection, movements_collection, ping_database, reservations_collection
+from database_connector import database_profile, movement_status_collection, start_journal_flusher
 
 
 def getISOtimestamp() -> str:
@@ -33,12 +38,53 @@ def generate500response(error: str) -> dict:
     }
 
 
+def generate409response(error: str) -> dict:
+    """ A function that generates a '409-Conflict' message """
+    return {
+        "status": 409,
+        "message": "Conflict",
+        "error": error
+    }
+
+
+def generate_reservation_error_response(error: reservations.ReservationError) -> dict:
+    """ A function that generates the error message of a failed reservation operation """
+    messages = {400: "Bad Request", 404: "Resource Not Found", 409: "Conflict"}
+    return {
+        "status": error.status,
+        "message": messages[error.status],
+        "error": str(error)
+    }
+
+
+# Read from the primary of the location service, so a location created a moment ago is found even when its GETs
+# are served by lagging secondaries
+READ_PRIMARY_HEADERS = {"X-Read-Primary": "true"}
+
+
+def location_exists(location_id: str) -> bool:
+    """This function checks if location id exists by making a GET request to the location service."""
+    import requests
+    URL = f"http://location-service/{location_id}"
+
+    res = requests.get(URL, headers=READ_PRIMARY_HEADERS)
+    if res.status_code != 200:
+        return False
+
+    return True
+
+
+def serialize(doc: dict) -> dict:
+    """ A function that converts a document to JSON """
+    return json.loads(json.dumps(doc, default=json_util.default))
+
+
 class Balance(Resource):
     def get(self):
         """RESTful GET method"""
         try:
-            # Get all documents in the collection
-            result_docs = list(collection.find())
+            # Get all documents in the collection, without the ids of the movements applied to them
+            result_docs = list(collection.find({}, {'applied_movements': 0}))
 
             # Convert to JSON
             result = json.loads(json.dumps(
@@ -78,7 +124,11 @@ class Balance(Resource):
                 return res, 400
 
             # Insert single document from POST body
-            result = collection.insert_one(data)
+            try:
+                result = collection.insert_one(data)
+            except DuplicateKeyError:
+                res = generate409response(f"Record with {product_id} and {location_id} already exists.")
+                return res, 409
 
             if not result.acknowledged:
                 response = generate500response("Database insertion failed.")
@@ -114,12 +164,20 @@ class Balance(Resource):
                 response = generate400response(f"product_id key required.")
                 return response, 400
 
-            if not qty:
+            if qty is None:
                 response = generate400response(f"qty key required.")
                 return response, 400
 
-            if int(qty) <= 0:
-                response = generate400response(f"qty cannot be less than or equal to zero.")
+            # A balance may be emptied by an outgoing movement
+            if int(qty) < 0:
+                response = generate400response(f"qty cannot be less than zero.")
+                return response, 400
+
+            # The reserved qty, the applied movement ids and the reorder point are only changed through their
+            # own endpoints, so a PUT cannot wipe out holds or the movement retry guard
+            other_keys = sorted(set(data) - {'product_id', 'location_id', 'qty'})
+            if other_keys:
+                response = generate400response(f"Only qty can be updated, got {', '.join(other_keys)}.")
                 return response, 400
 
             # Check if record exists with given product and location id
@@ -134,8 +192,13 @@ class Balance(Resource):
                     f"Record with {product_id} and {location_id} does not exist.")
                 return response, 400
 
-            # Replace single document with request body
-            result = collection.replace_one(filters, data)
+            # Update the qty, as long as it still covers the reserved qty
+            result = collection.update_one({**filters, **adjustments.reserved_at_most(int(qty))},
+                                           {'$set': {'qty': int(qty)}})
+
+            if result.acknowledged and not result.matched_count:
+                response = generate409response("qty cannot be less than the reserved qty.")
+                return response, 409
 
             if not result.acknowledged:
                 response = generate500response("Database query failed.")
@@ -192,10 +255,286 @@ class Balance(Resource):
             return res, 500
 
 
+class BalanceAdjustment(Resource):
+    def post(self):
+        """RESTful POST method changing the qty of a product at a location by qty_change.
+
+        Unlike PUT, the change is applied relative to the current qty in a single update, so concurrent movements
+        and reservation commits never overwrite each other. An optional movement_id makes retries of the same
+        movement a no-op, answered with 200 instead of 201.
+        """
+        try:
+            data = request.get_json()
+
+            product_id = data.get('product_id')
+            location_id = data.get('location_id')
+            qty_change = data.get('qty_change')
+            movement_id = data.get('movement_id')
+
+            if not product_id:
+                response = generate400response("product_id key required.")
+                return response, 400
+
+            if not location_id:
+                response = generate400response("location_id key required.")
+                return response, 400
+
+            if not isinstance(qty_change, int) or not qty_change:
+                response = generate400response("qty_change is required and must be a non zero integer.")
+                return response, 400
+
+            try:
+                previous_qty, qty, applied, reorder_point = adjustments.adjust(collection, product_id, location_id,
+                                                                               qty_change, movement_id)
+            except adjustments.BalanceNotFoundError as error:
+                response = generate400response(str(error))
+                return response, 400
+            except adjustments.InsufficientQtyError as error:
+                response = generate409response(str(error))
+                return response, 409
+
+            if not applied:
+                return {
+                    "status": 200,
+                    "message": "Success",
+                    "timestamp": getISOtimestamp(),
+                    "previous_qty": previous_qty,
+                    "qty": qty,
+                    "reorder_point": reorder_point,
+                    "result": f"Movement {movement_id} was already applied."
+                }, 200
+
+            return {
+                "status": 201,
+                "message": "Success",
+                "timestamp": getISOtimestamp(),
+                "previous_qty": previous_qty,
+                "qty": qty,
+                "reorder_point": reorder_point
+            }, 201
+
+        except Exception as error:
+            response = generate500response(str(error))
+            return response, 500
+
+
+class Thresholds(Resource):
+    def put(self):
+        """RESTful PUT method setting the reorder point of a product at a location"""
+        try:
+            data = request.get_json()
+
+            product_id = data.get('product_id')
+            location_id = data.get('location_id')
+            reorder_point = data.get('reorder_point')
+
+            if not product_id:
+                response = generate400response("product_id key required.")
+                return response, 400
+
+            if not location_id:
+                response = generate400response("location_id key required.")
+                return response, 400
+
+            # A null reorder point removes the threshold
+            if reorder_point is not None and (not isinstance(reorder_point, int) or reorder_point < 0):
+                response = generate400response("reorder_point must be an integer greater than or equal to zero.")
+                return response, 400
+
+            filters = {
+                'product_id': product_id,
+                'location_id': location_id
+            }
+
+            if reorder_point is None:
+                update = {'$unset': {'reorder_point': ''}}
+            else:
+                update = {'$set': {'reorder_point': reorder_point}}
+
+            result = collection.update_one(filters, update)
+
+            if not result.matched_count:
+                response = generate400response(
+                    f"Record with {product_id} and {location_id} does not exist.")
+                return response, 400
+
+            return {
+                "status": 201,
+                "message": "Success",
+                "timestamp": getISOtimestamp(),
+                "result": "Reorder point updated successfully"
+            }, 201
+
+        except Exception as error:
+            response = generate500response(str(error))
+            return response, 500
+
+
+class Reservations(Resource):
+    def get(self, reservation_id: str):
+        """RESTful GET method"""
+        try:
+            if not ObjectId.is_valid(reservation_id):
+                raise reservations.ReservationNotFoundError(f"Reservation with id: {reservation_id} does not exist.")
+
+            hold = reservations_collection.find_one({'_id': ObjectId(reservation_id)})
+            if not hold:
+                raise reservations.ReservationNotFoundError(f"Reservation with id: {reservation_id} does not exist.")
+
+            return {
+                "status": 200,
+                "message": "Success",
+                "timestamp": getISOtimestamp(),
+                "data": serialize(hold)
+            }, 200
+
+        except reservations.ReservationError as error:
+            return generate_reservation_error_response(error), error.status
+
+        except Exception as error:
+            res = generate500response(str(error))
+            return res, 500
+
+    def post(self):
+        """RESTful POST method holding qty of a product at a location until committed, released or expired"""
+        try:
+            data = request.get_json()
+
+            product_id = data.get('product_id')
+            location_id = data.get('location_id')
+            qty = data.get('qty')
+            ttl_seconds = data.get('ttl_seconds', reservations.RESERVATION_DEFAULT_TTL_SECONDS)
+
+            if not product_id:
+                res = generate400response("product_id key required.")
+                return res, 400
+
+            if not location_id:
+                res = generate400response("location_id key required.")
+                return res, 400
+
+            if not isinstance(qty, int) or qty <= 0:
+                res = generate400response("qty is required and must be an integer greater than zero.")
+                return res, 400
+
+            if not isinstance(ttl_seconds, int) or not 0 < ttl_seconds <= reservations.RESERVATION_MAX_TTL_SECONDS:
+                res = generate400response(
+                    f"ttl_seconds must be an integer between 1 and {reservations.RESERVATION_MAX_TTL_SECONDS}.")
+                return res, 400
+
+            hold = reservations.reserve(collection, reservations_collection, product_id, location_id, qty,
+                                        ttl_seconds, data.get('order_id'))
+
+            return {
+                "status": 201,
+                "message": "Success",
+                "timestamp": getISOtimestamp(),
+                "data": serialize(hold),
+                "result": f"reservation with id: {hold['_id']} created."
+            }, 201
+
+        except reservations.ReservationError as error:
+            return generate_reservation_error_response(error), error.status
+
+        except Exception as error:
+            res = generate500response(str(error))
+            return res, 500
+
+
+class ReservationCommit(Resource):
+    def post(self, reservation_id: str):
+        """RESTful POST method turning a held reservation into a movement out of its location"""
+        try:
+            data = request.get_json(silent=True) or {}
+            to_location = data.get('to_location', '')
+
+            if to_location and not location_exists(to_location):
+                res = generate400response("to_location does not exist.")
+                return res, 400
+
+            movement = reservations.commit(collection, reservations_collection, movements_collection,
+                                           movement_status_collection,
+                                           reservation_id, to_location)
+
+            return {
+                "status": 201,
+                "message": "Success",
+                "timestamp": getISOtimestamp(),
+                "data": serialize(movement),
+                "result": f"reservation with id: {reservation_id} committed."
+            }, 201
+
+        except reservations.ReservationError as error:
+            return generate_reservation_error_response(error), error.status
+
+        except Exception as error:
+            res = generate500response(str(error))
+            return res, 500
+
+
+class ReservationRelease(Resource):
+    def post(self, reservation_id: str):
+        """RESTful POST method releasing a held reservation"""
+        try:
+            reservations.release(collection, reservations_collection, reservation_id)
+
+            return {
+                "status": 200,
+                "message": "Success",
+                "timestamp": getISOtimestamp(),
+                "result": f"reservation with id: {reservation_id} released."
+            }, 200
+
+        except reservations.ReservationError as error:
+            return generate_reservation_error_response(error), error.status
+
+        except Exception as error:
+            res = generate500response(str(error))
+            return res, 500
+
+
+class Liveness(Resource):
+    def get(self):
+        """Liveness probe, the process is up and serving requests"""
+        return {"status": 200, "message": "Alive", "timestamp": getISOtimestamp()}, 200
+
+
+class Readiness(Resource):
+    def get(self):
+        """Readiness probe, the database is reachable"""
+        checks = {"database": ping_database()}
+        status = 200 if all(checks.values()) else 503
+
+        return {
+            "status": status,
+            "message": "Ready" if status == 200 else "Not Ready",
+            "timestamp": getISOtimestamp(),
+            "checks": checks,
+            "database": database_profile()
+        }, status
+
+
+# The sweeper creates the indexes itself, retrying while the database is unreachable
+reservations.ReservationSweeper(collection, reservations_collection, movements_collection,
+                                movement_status_collection).start()
+
+try:
+    start_journal_flusher()
+except Exception as error:
+    logging.warning(f"Could not start journal flusher: {error}")
+
 app = Flask(__name__)
 api = Api(app)
+init_compression(app)
 
 api.add_resource(Balance, '/')
+api.add_resource(BalanceAdjustment, '/adjustments')
+api.add_resource(Thresholds, '/thresholds')
+api.add_resource(Reservations, '/reservations', '/reservations/<string:reservation_id>')
+api.add_resource(ReservationCommit, '/reservations/<string:reservation_id>/commit')
+api.add_resource(ReservationRelease, '/reservations/<string:reservation_id>/release')
+api.add_resource(Liveness, '/healthz')
+api.add_resource(Readiness, '/readyz')
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
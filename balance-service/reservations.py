@@ -0,0 +1,337 @@
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+
+import pymongo
+from bson import ObjectId
+from decouple import config
+from pymongo.errors import DuplicateKeyError, OperationFailure
+
+from adjustments import adjust, available_at_least
+from stock_events import check_threshold
+
+RESERVATION_DEFAULT_TTL_SECONDS = config("RESERVATION_DEFAULT_TTL_SECONDS", default=900, cast=int)
+RESERVATION_MAX_TTL_SECONDS = config("RESERVATION_MAX_TTL_SECONDS", default=86400, cast=int)
+RESERVATION_SWEEP_INTERVAL_SECONDS = config("RESERVATION_SWEEP_INTERVAL_SECONDS", default=5, cast=int)
+
+# Expired holds are released by the sweeper, the TTL index then purges every hold this long after it expired
+RESERVATION_PURGE_AFTER_SECONDS = config("RESERVATION_PURGE_AFTER_SECONDS", default=86400, cast=int)
+# Commits that failed halfway are finished by the sweeper once they are this old
+RESERVATION_COMMIT_RETRY_SECONDS = config("RESERVATION_COMMIT_RETRY_SECONDS", default=60, cast=int)
+
+HELD = 'held'
+COMMITTED = 'committed'
+RELEASED = 'released'
+EXPIRED = 'expired'
+
+# Movement status read by the movement service status endpoint
+APPLIED = 'applied'
+
+
+class ReservationError(Exception):
+    """Base class of reservation errors, `status` is the HTTP status code to respond with."""
+    status = 400
+
+
+class InsufficientStockError(ReservationError):
+    status = 409
+
+
+class ReservationNotFoundError(ReservationError):
+    status = 404
+
+
+class ReservationStateError(ReservationError):
+    status = 409
+
+
+class DuplicateBalancesError(Exception):
+    """Raised when a product has several balance records at a location, which the unique index cannot cover."""
+
+
+# Error codes of creating an index whose name or keys already exist with other options
+INDEX_CONFLICT_CODES = (85, 86)
+DUPLICATE_KEY_CODE = 11000
+
+
+def find_duplicate_balances(balance_collection, limit: int = 5) -> list:
+    """Returns up to `limit` (product_id, location_id) pairs stored in more than one balance record"""
+    return list(balance_collection.aggregate([
+        {'$group': {'_id': {'product_id': '$product_id', 'location_id': '$location_id'}, 'count': {'$sum': 1}}},
+        {'$match': {'count': {'$gt': 1}}},
+        {'$limit': limit}
+    ]))
+
+
+def ensure_indexes(balance_collection, reservations_collection) -> None:
+    """Creates the reservation indexes and makes (product_id, location_id) unique, so concurrent upserts cannot
+    create a balance twice.
+
+    Raises DuplicateBalancesError, keeping any existing non-unique index, while balances written twice by earlier
+    versions remain. They have to be merged by hand before the unique index can be built.
+    """
+    keys = [('product_id', pymongo.ASCENDING), ('location_id', pymongo.ASCENDING)]
+    try:
+        balance_collection.create_index(keys, unique=True)
+    except OperationFailure as error:
+        if error.code not in INDEX_CONFLICT_CODES + (DUPLICATE_KEY_CODE,):
+            raise
+
+        duplicates = find_duplicate_balances(balance_collection)
+        if duplicates:
+            pairs = ', '.join(f"{duplicate['_id'].get('product_id')} at {duplicate['_id'].get('location_id')} "
+                              f"({duplicate['count']} records)" for duplicate in duplicates)
+            raise DuplicateBalancesError(f"Balances stored more than once, merge them to build the unique index: "
+                                         f"{pairs}.")
+
+        if error.code == DUPLICATE_KEY_CODE:
+            raise
+
+        # Replace the index created without unique by earlier versions
+        balance_collection.drop_index(keys)
+        try:
+            balance_collection.create_index(keys, unique=True)
+        except OperationFailure:
+            # A duplicate was written in the meantime, restore the index the balance queries rely on
+            balance_collection.create_index(keys)
+            raise
+
+    reservations_collection.create_index([('status', pymongo.ASCENDING), ('expires_at', pymongo.ASCENDING)])
+    reservations_collection.create_index('expires_at', expireAfterSeconds=RESERVATION_PURGE_AFTER_SECONDS)
+
+
+def reserve(balance_collection, reservations_collection, product_id: str, location_id: str, qty: int,
+            ttl_seconds: int = RESERVATION_DEFAULT_TTL_SECONDS, order_id: str = None) -> dict:
+    """Holds `qty` units of a product at a location, returns the hold.
+
+    The available quantity is checked and reserved in a single conditional update, so concurrent reservations
+    of the same balance can never oversell it.
+    """
+    result = balance_collection.update_one(
+        {'product_id': product_id, 'location_id': location_id, **available_at_least(qty)},
+        {'$inc': {'reserved': qty}}
+    )
+
+    if not result.modified_count:
+        raise InsufficientStockError(f"Not enough available qty of {product_id} at {location_id}.")
+
+    now = datetime.utcnow()
+    hold = {
+        '_id': ObjectId(),
+        'product_id': product_id,
+        'location_id': location_id,
+        'qty': qty,
+        'order_id': order_id,
+        'status': HELD,
+        'created_at': now,
+        'expires_at': now + timedelta(seconds=ttl_seconds),
+    }
+
+    try:
+        reservations_collection.insert_one(hold)
+    except Exception:
+        # Give the quantity back if the hold could not be recorded
+        balance_collection.update_one({'product_id': product_id, 'location_id': location_id},
+                                      {'$inc': {'reserved': -qty}})
+        raise
+
+    return hold
+
+
+def transition(reservations_collection, reservation_id: str, status: str, only_unexpired: bool = True,
+               fields: dict = None) -> dict:
+    """Atomically moves a held reservation to `status`, setting `fields` too, returns the hold as it was before
+    the change"""
+    if not ObjectId.is_valid(reservation_id):
+        raise ReservationNotFoundError(f"Reservation with id: {reservation_id} does not exist.")
+
+    filters = {'_id': ObjectId(reservation_id), 'status': HELD}
+    if only_unexpired:
+        filters['expires_at'] = {'$gt': datetime.utcnow()}
+
+    hold = reservations_collection.find_one_and_update(filters, {'$set': {'status': status,
+                                                                         'updated_at': datetime.utcnow(),
+                                                                         **(fields or {})}})
+    if hold:
+        return hold
+
+    existing = reservations_collection.find_one({'_id': ObjectId(reservation_id)})
+    if not existing:
+        raise ReservationNotFoundError(f"Reservation with id: {reservation_id} does not exist.")
+
+    if existing['status'] == HELD:
+        raise ReservationStateError(f"Reservation with id: {reservation_id} has expired.")
+
+    raise ReservationStateError(f"Reservation with id: {reservation_id} is already {existing['status']}.")
+
+
+def release(balance_collection, reservations_collection, reservation_id: str) -> dict:
+    """Releases a held reservation and makes its quantity available again"""
+    hold = transition(reservations_collection, reservation_id, RELEASED, only_unexpired=False)
+    balance_collection.update_one({'product_id': hold['product_id'], 'location_id': hold['location_id']},
+                                  {'$inc': {'reserved': -hold['qty']}})
+    return hold
+
+
+def commit(balance_collection, reservations_collection, movements_collection, movement_status_collection,
+           reservation_id: str, to_location: str = '') -> dict:
+    """Turns a held reservation into a movement out of its location, or into `to_location` if given.
+
+    The hold is marked committed first, with its destination and a `commit_pending` flag. The reserved quantity
+    is then taken out of the balance, as it is already held no stock check is needed. The movement is recorded
+    with the reservation id for history, it is not published to the movement log since the balance has already
+    been updated. Its status is recorded as applied right away, as the movement log consumer that records the
+    status of other movements never sees it.
+
+    Every step after the first is keyed by the reservation id, so a commit that failed halfway is finished by
+    retrying it, or by the sweeper after RESERVATION_COMMIT_RETRY_SECONDS, without applying any step twice.
+    """
+    try:
+        hold = transition(reservations_collection, reservation_id, COMMITTED,
+                          fields={'to_location': to_location, 'commit_pending': True})
+        hold.update({'to_location': to_location, 'commit_pending': True})
+    except ReservationStateError:
+        # Resume a commit that failed halfway
+        hold = reservations_collection.find_one({'_id': ObjectId(reservation_id), 'status': COMMITTED,
+                                                 'commit_pending': True})
+        if not hold:
+            raise
+        if hold['to_location'] != to_location:
+            raise ReservationStateError(f"Reservation with id: {reservation_id} is being committed to "
+                                        f"{hold['to_location'] or 'no location'}.")
+
+    return finish_commit(balance_collection, reservations_collection, movements_collection,
+                         movement_status_collection, hold)
+
+
+def finish_commit(balance_collection, reservations_collection, movements_collection, movement_status_collection,
+                  hold: dict) -> dict:
+    """Applies the steps of a commit after the hold was marked committed, skipping those already done"""
+    reservation_id = str(hold['_id'])
+    qty = hold['qty']
+    to_location = hold['to_location']
+
+    previous_qty, new_qty, applied, reorder_point = adjust(balance_collection, hold['product_id'],
+                                                           hold['location_id'], -qty, movement_id=reservation_id,
+                                                           reserved_change=-qty)
+    # A step applied by an earlier attempt already had its chance to publish
+    if applied:
+        check_threshold(hold['product_id'], hold['location_id'], previous_qty, new_qty, reorder_point)
+
+    if to_location:
+        previous_qty, new_qty, applied, reorder_point = adjust(balance_collection, hold['product_id'], to_location,
+                                                               qty, movement_id=reservation_id)
+        if applied:
+            check_threshold(hold['product_id'], to_location, previous_qty, new_qty, reorder_point)
+
+    movement = {
+        '_id': hold['_id'],
+        'from_location': hold['location_id'],
+        'to_location': to_location,
+        'product_id': hold['product_id'],
+        'quantity': qty,
+        'reservation_id': reservation_id,
+    }
+    try:
+        movements_collection.insert_one(movement)
+    except DuplicateKeyError:
+        # Recorded by an earlier attempt
+        pass
+
+    movement_status_collection.replace_one(
+        {'_id': movement['_id']},
+        {'status': APPLIED, 'error': None, 'updated_at': datetime.utcnow()},
+        upsert=True
+    )
+    reservations_collection.update_one({'_id': hold['_id']}, {'$unset': {'commit_pending': ''},
+                                                              '$set': {'updated_at': datetime.utcnow()}})
+
+    return movement
+
+
+def finish_pending_commits(balance_collection, reservations_collection, movements_collection,
+                           movement_status_collection) -> int:
+    """Finishes every commit left pending for RESERVATION_COMMIT_RETRY_SECONDS, returns the number finished"""
+    finished = 0
+
+    while True:
+        # Claimed by moving updated_at, so a commit that fails again is retried on a later sweep
+        hold = reservations_collection.find_one_and_update(
+            {'status': COMMITTED, 'commit_pending': True,
+             'updated_at': {'$lte': datetime.utcnow() - timedelta(seconds=RESERVATION_COMMIT_RETRY_SECONDS)}},
+            {'$set': {'updated_at': datetime.utcnow()}}
+        )
+        if not hold:
+            return finished
+
+        finish_commit(balance_collection, reservations_collection, movements_collection,
+                      movement_status_collection, hold)
+        finished += 1
+
+
+def release_expired(balance_collection, reservations_collection) -> int:
+    """Releases every held reservation past its expiry, returns the number of released holds"""
+    released = 0
+
+    while True:
+        hold = reservations_collection.find_one_and_update(
+            {'status': HELD, 'expires_at': {'$lte': datetime.utcnow()}},
+            {'$set': {'status': EXPIRED, 'updated_at': datetime.utcnow()}}
+        )
+        if not hold:
+            return released
+
+        balance_collection.update_one({'product_id': hold['product_id'], 'location_id': hold['location_id']},
+                                      {'$inc': {'reserved': -hold['qty']}})
+        released += 1
+
+
+class ReservationSweeper(threading.Thread):
+    """Background thread creating the reservation indexes, releasing expired holds and finishing commits that
+    failed halfway.
+
+    Index creation is retried on every run until it succeeds, holds are released regardless.
+    """
+
+    def __init__(self, balance_collection, reservations_collection, movements_collection,
+                 movement_status_collection, interval: int = RESERVATION_SWEEP_INTERVAL_SECONDS):
+        super().__init__(daemon=True)
+        self.balance_collection = balance_collection
+        self.reservations_collection = reservations_collection
+        self.movements_collection = movements_collection
+        self.movement_status_collection = movement_status_collection
+        self.interval = interval
+        self.indexes_ready = False
+        self.index_error = None
+
+    def run(self):
+        while True:
+            if not self.indexes_ready:
+                try:
+                    ensure_indexes(self.balance_collection, self.reservations_collection)
+                    self.indexes_ready = True
+                except DuplicateBalancesError as error:
+                    # Retried so the index is built once the balances are merged, logged once until then
+                    if str(error) != self.index_error:
+                        logging.error(f"Could not create reservation indexes: {error}")
+                    self.index_error = str(error)
+                except Exception as error:
+                    logging.warning(f"Could not create reservation indexes: {error}")
+
+            try:
+                released = release_expired(self.balance_collection, self.reservations_collection)
+                if released:
+                    logging.info(f"Released {released} expired reservations.")
+            except Exception as error:
+                logging.warning(f"Releasing expired reservations failed: {error}")
+
+            try:
+                finished = finish_pending_commits(self.balance_collection, self.reservations_collection,
+                                                  self.movements_collection, self.movement_status_collection)
+                if finished:
+                    logging.info(f"Finished {finished} pending reservation commits.")
+            except Exception as error:
+                logging.warning(f"Finishing pending reservation commits failed: {error}")
+
+            time.sleep(self.interval)
@@ -0,0 +1,63 @@
+import json
+import logging
+from datetime import datetime
+
+import pika
+from decouple import config
+
+RABBITMQ_HOST = config("RABBITMQ_HOST", default="rabbitmq")
+BROKER_SOCKET_TIMEOUT_SECONDS = config("BROKER_SOCKET_TIMEOUT_SECONDS", default=2.0, cast=float)
+
+# Same exchange and routing keys as the movement log consumer, so subscribers see the events of reservation
+# commits next to those of movements
+STOCK_EVENTS_EXCHANGE = 'stock_events'
+LOW_STOCK_ROUTING_KEY = 'stock.low'
+RESTORED_ROUTING_KEY = 'stock.restored'
+
+
+def publish(routing_key: str, event: dict) -> None:
+    """Publishes an event on the stock events exchange.
+
+    Events are only published when a commit crosses a reorder point, so a connection is opened per event rather
+    than shared between request threads.
+    """
+    parameters = pika.ConnectionParameters(host=RABBITMQ_HOST, connection_attempts=1,
+                                           socket_timeout=BROKER_SOCKET_TIMEOUT_SECONDS)
+    connection = pika.BlockingConnection(parameters)
+    try:
+        channel = connection.channel()
+        channel.exchange_declare(exchange=STOCK_EVENTS_EXCHANGE, exchange_type='topic', durable=True)
+        channel.basic_publish(exchange=STOCK_EVENTS_EXCHANGE, routing_key=routing_key, body=json.dumps(event),
+                              properties=pika.BasicProperties(content_type='application/json', delivery_mode=2))
+    finally:
+        connection.close()
+
+    logging.info(f"Published {routing_key} event: {event}")
+
+
+def check_threshold(product_id: str, location_id: str, old_qty: int, new_qty: int, reorder_point) -> None:
+    """Publishes an event if a qty change crosses the reorder point of the balance it was applied to"""
+    if reorder_point is None:
+        return
+
+    if old_qty > reorder_point >= new_qty:
+        routing_key = LOW_STOCK_ROUTING_KEY
+    elif old_qty <= reorder_point < new_qty:
+        routing_key = RESTORED_ROUTING_KEY
+    else:
+        return
+
+    event = {
+        'product_id': product_id,
+        'location_id': location_id,
+        'qty': new_qty,
+        'previous_qty': old_qty,
+        'reorder_point': reorder_point,
+        'timestamp': datetime.now().isoformat()
+    }
+
+    # The balance is already updated, a failed event must not fail the commit
+    try:
+        publish(routing_key, event)
+    except Exception as error:
+        logging.warning(f"Failed publishing {routing_key} event {event}: {error}")
@@ -0,0 +1,45 @@
+"""Adds the GeoJSON `location` point to locations created before it was stored on insert.
+
+Usage: python backfill_location_points.py
+"""
+import logging
+
+from pymongo import UpdateOne
+
+from database_connector import collection, ensure_indexes
+from geo import to_geojson_point
+
+BATCH_SIZE = 1000
+
+
+def backfill() -> int:
+    """Sets the location point on every document missing it, returns the number of updated documents"""
+    updated = 0
+    batch = []
+
+    cursor = collection.find({'location': {'$exists': False}},
+                             {'location_latitude': 1, 'location_longitude': 1})
+
+    for doc in cursor:
+        try:
+            point = to_geojson_point(doc.get('location_latitude'), doc.get('location_longitude'))
+        except ValueError as error:
+            logging.warning(f"Skipping location {doc['_id']}: {error}")
+            continue
+
+        batch.append(UpdateOne({'_id': doc['_id']}, {'$set': {'location': point}}))
+
+        if len(batch) >= BATCH_SIZE:
+            updated += collection.bulk_write(batch, ordered=False).modified_count
+            batch = []
+
+    if batch:
+        updated += collection.bulk_write(batch, ordered=False).modified_count
+
+    return updated
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    ensure_indexes()
+    logging.info(f"Backfilled {backfill()} locations.")
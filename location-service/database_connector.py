@@ -1,6 +1,91 @@
 import pymongo
-from decouple import config
+from decouple import Choices, config
+from pymongo.read_preferences import Nearest, Primary, PrimaryPreferred, Secondary, SecondaryPreferred
 
-client = pymongo.MongoClient(config("DB_CONNECTION_STRING"))
+DB_MAX_POOL_SIZE = config("DB_MAX_POOL_SIZE", default=100, cast=int)
+DB_MIN_POOL_SIZE = config("DB_MIN_POOL_SIZE", default=0, cast=int)
+
+# Catalog GETs may be served by secondaries lagging at most CATALOG_MAX_STALENESS_SECONDS behind the primary
+# (-1 for no bound, otherwise at least 90), writes always go to the primary
+CATALOG_READ_PREFERENCE = config("CATALOG_READ_PREFERENCE", default="primary",
+                                 cast=Choices(['primary', 'primaryPreferred', 'secondary', 'secondaryPreferred',
+                                               'nearest']))
+CATALOG_MAX_STALENESS_SECONDS = config("CATALOG_MAX_STALENESS_SECONDS", default=-1, cast=int)
+# Rejected at startup, pymongo would otherwise only fail at server selection on every catalog GET
+if CATALOG_MAX_STALENESS_SECONDS != -1 and CATALOG_MAX_STALENESS_SECONDS < 90:
+    raise ValueError(f"CATALOG_MAX_STALENESS_SECONDS must be -1 or at least 90, got {CATALOG_MAX_STALENESS_SECONDS}.")
+
+# Callers that must see their own or other services' latest writes, such as the existence checks of the movement
+# service, send this header to read from the primary
+READ_PRIMARY_HEADER = "X-Read-Primary"
+TRUE_VALUES = ('true', '1', 'yes', 'on')
+FALSE_VALUES = ('false', '0', 'no', 'off', '')
+
+
+def read_primary_requested(value) -> bool:
+    """Parses the READ_PRIMARY_HEADER value, a missing header reads with the catalog read preference.
+    Raises ValueError for values other than true/false, 1/0, yes/no or on/off."""
+    if value is None:
+        return False
+
+    value = value.strip().lower()
+    if value in TRUE_VALUES:
+        return True
+    if value in FALSE_VALUES:
+        return False
+
+    raise ValueError(f"{READ_PRIMARY_HEADER} must be true or false.")
+
+READ_PREFERENCES = {
+    'primaryPreferred': PrimaryPreferred,
+    'secondary': Secondary,
+    'secondaryPreferred': SecondaryPreferred,
+    'nearest': Nearest,
+}
+
+
+def catalog_read_preference():
+    if CATALOG_READ_PREFERENCE == 'primary':
+        return Primary()
+
+    return READ_PREFERENCES[CATALOG_READ_PREFERENCE](max_staleness=CATALOG_MAX_STALENESS_SECONDS)
+
+
+# Bound how long an operation waits for a reachable server so health checks fail fast while the database is down
+client = pymongo.MongoClient(config("DB_CONNECTION_STRING"),
+                             serverSelectionTimeoutMS=config("DB_SERVER_SELECTION_TIMEOUT_MS", default=5000, cast=int),
+                             maxPoolSize=DB_MAX_POOL_SIZE, minPoolSize=DB_MIN_POOL_SIZE)
 db = client["locations"]
 collection = db["locations"]
+# GET requests read with the catalog read preference, writes and reads sent with READ_PRIMARY_HEADER go through
+# `collection`
+read_collection = collection.with_options(read_preference=catalog_read_preference())
+
+# Balance is read directly for stock aware location queries, it lives in its own database on the same cluster
+balance_db = client["balance"]
+balance_collection = balance_db["balance"]
+
+
+def database_profile() -> dict:
+    """Describes the active catalog read preference and pool limits, reported by the readiness endpoint"""
+    return {
+        'read_preference': CATALOG_READ_PREFERENCE,
+        'max_staleness_seconds': CATALOG_MAX_STALENESS_SECONDS,
+        'max_pool_size': DB_MAX_POOL_SIZE,
+        'min_pool_size': DB_MIN_POOL_SIZE,
+    }
+
+
+def ping_database() -> bool:
+    """Checks if the database is reachable"""
+    try:
+        client.admin.command('ping')
+        return True
+    except pymongo.errors.PyMongoError:
+        return False
+
+
+def ensure_indexes() -> None:
+    """Creates the indexes used by the nearest location query"""
+    collection.create_index([('location', pymongo.GEOSPHERE)])
+    balance_collection.create_index([('product_id', pymongo.ASCENDING), ('qty', pymongo.DESCENDING)])
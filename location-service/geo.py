@@ -0,0 +1,20 @@
+def to_geojson_point(latitude, longitude) -> dict:
+    """A function that converts coordinates to a GeoJSON point, note that GeoJSON orders longitude first"""
+    try:
+        latitude = float(latitude)
+        longitude = float(longitude)
+    except (TypeError, ValueError):
+        raise ValueError("location_latitude and location_longitude must be numbers.")
+
+    if not -90 <= latitude <= 90:
+        raise ValueError("location_latitude must be between -90 and 90.")
+
+    if not -180 <= longitude <= 180:
+        raise ValueError("location_longitude must be between -180 and 180.")
+
+    return {"type": "Point", "coordinates": [longitude, latitude]}
+
+
+def is_missing(value) -> bool:
+    """A coordinate is missing if it is absent or empty, 0 is a valid latitude or longitude"""
+    return value is None or value == ''
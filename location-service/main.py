@@ -2,9 +2,16 @@ import logging
 from flask_restful import Api, Resource
 from flask import Flask, request
 from datetime import datetime
-from database_connector import collection
+from compression import init_compression
+from database_connector import collection, balance_collection, ensure_indexes, ping_database, read_collection
+from database_connector import READ_PRIMARY_HEADER, database_profile, read_primary_requested
 import json
 from bson import json_util, ObjectId
+from bulk_import import import_rows, iter_rows
+from geo import is_missing, to_geojson_point
+
+# Upper bound on the number of locations returned by a nearest location query
+MAX_NEAREST_LOCATIONS = 100
 
 
 def getISOtimestamp() -> str:
@@ -31,6 +38,33 @@ def generate500response(error: str) -> dict:
     }
 
 
+def prepare_location(data: dict) -> str:
+    """Validates a new location and adds derived fields, returns an error message if the location is invalid"""
+    if not data.get('location_name'):
+        return "location_name key required."
+
+    if is_missing(data.get('location_latitude')):
+        return "location_latitude key required."
+
+    if is_missing(data.get('location_longitude')):
+        return "location_longitude key required."
+
+    # Keep a GeoJSON point alongside the scalar coordinates for proximity queries
+    try:
+        data['location'] = to_geojson_point(data['location_latitude'], data['location_longitude'])
+    except ValueError as error:
+        return str(error)
+
+
+def prepare_imported_location(data: dict) -> str:
+    """Validates an imported location, coordinates are stored as numbers since CSV cells are read as text"""
+    error = prepare_location(data)
+    if error:
+        return error
+
+    data['location_longitude'], data['location_latitude'] = data['location']['coordinates']
+
+
 class Locations(Resource):
     def get(self, location_id: str = None):
         """RESTful GET method"""
@@ -41,8 +75,17 @@ class Locations(Resource):
             if location_id:
                 filters.update({'_id': ObjectId(location_id)})
 
+            # Read from the primary when the caller asks for it, e.g. to check a location that was just created
+            try:
+                read_primary = read_primary_requested(request.headers.get(READ_PRIMARY_HEADER))
+            except ValueError as error:
+                response = generate400response(str(error))
+                return response, 400
+
+            source = collection if read_primary else read_collection
+
             # Get locations documents from collection as list
-            result_docs = list(collection.find(filters))
+            result_docs = list(source.find(filters))
 
             # Convert to JSON
             result = json.loads(json.dumps(
@@ -74,23 +117,10 @@ class Locations(Resource):
 
             data = request.get_json()
 
-            location_name = data['location_name']
-            location_latitude = data['location_latitude']
-            location_longitude = data['location_longitude']
-
             # Location name and coordinates is mandatory
-            if not location_name:
-                response = generate400response(f"location_name key required.")
-                return response, 400
-
-            if not location_latitude:
-                response = generate400response(
-                    f"location_latitude key required.")
-                return response, 400
-
-            if not location_longitude:
-                response = generate400response(
-                    f"location_longitude key required.")
+            error = prepare_location(data)
+            if error:
+                response = generate400response(error)
                 return response, 400
 
             # Insert single document from user POST body
@@ -131,12 +161,12 @@ class Locations(Resource):
                 response = generate400response("location_name key required")
                 return response, 400
 
-            if not location_latitude:
+            if is_missing(location_latitude):
                 response = generate400response(
                     f"location_latitude key required.")
                 return response, 400
 
-            if not location_longitude:
+            if is_missing(location_longitude):
                 response = generate400response(
                     f"location_longitude key required.")
                 return response, 400
@@ -163,6 +193,12 @@ class Locations(Resource):
             # Pop location_id key from user request body to pass it to update query without changing location_id
             data.pop('location_id', None)
 
+            try:
+                data['location'] = to_geojson_point(location_latitude, location_longitude)
+            except ValueError as error:
+                response = generate400response(str(error))
+                return response, 400
+
             # Replace single document with user request body
             result = collection.replace_one(
                 {'_id': ObjectId(location_id)}, data)
@@ -183,10 +219,182 @@ class Locations(Resource):
             return response, 500
 
 
+class LocationImport(Resource):
+    def post(self):
+        """RESTful POST method importing locations streamed as CSV or NDJSON, one location per row"""
+        try:
+            try:
+                rows = iter_rows(request.stream, request.content_type)
+            except ValueError as error:
+                response = generate400response(str(error))
+                return response, 400
+
+            report = import_rows(collection, rows, prepare_imported_location)
+
+            if report.database_error:
+                # Earlier chunks are already inserted, report them so the client can resume
+                return {
+                    "status": 503,
+                    "message": "Service Unavailable",
+                    "error": f"Import stopped at row {report.failed_row}, the database failed: "
+                             f"{report.database_error}. Rows from {report.failed_row} on may be partly inserted.",
+                    "timestamp": getISOtimestamp(),
+                    "failed_row": report.failed_row,
+                    "inserted_count": report.inserted_count,
+                    "error_count": report.error_count,
+                    "errors": report.errors
+                }, 503
+
+            if report.failed_row:
+                # Rows before the failed row are already inserted, report them so the client can resume
+                return {
+                    "status": 400,
+                    "message": "Bad Request",
+                    "error": f"Import stopped at row {report.failed_row}, the stream could not be read further.",
+                    "timestamp": getISOtimestamp(),
+                    "failed_row": report.failed_row,
+                    "inserted_count": report.inserted_count,
+                    "error_count": report.error_count,
+                    "errors": report.errors
+                }, 400
+
+            return {
+                "status": 201,
+                "message": "Success",
+                "timestamp": getISOtimestamp(),
+                "inserted_count": report.inserted_count,
+                "error_count": report.error_count,
+                "errors": report.errors
+            }, 201
+
+        except Exception as error:
+            response = generate500response(str(error))
+            return response, 500
+
+
+indexes_ready = False
+
+
+def ensure_indexes_ready() -> None:
+    """Creates the nearest location indexes on first use, so they are created by the next query
+    instead of failing until a restart if the database was unreachable at startup"""
+    global indexes_ready
+    if not indexes_ready:
+        ensure_indexes()
+        indexes_ready = True
+
+
+class NearestLocations(Resource):
+    def get(self):
+        """RESTful GET method returning the K nearest locations holding at least min_qty units of a product"""
+        try:
+            product_id = request.args.get('product_id')
+            latitude = request.args.get('latitude')
+            longitude = request.args.get('longitude')
+
+            if not product_id:
+                response = generate400response("product_id query parameter required.")
+                return response, 400
+
+            if not latitude or not longitude:
+                response = generate400response("latitude and longitude query parameters required.")
+                return response, 400
+
+            try:
+                point = to_geojson_point(latitude, longitude)
+                min_qty = int(request.args.get('min_qty', 1))
+                k = int(request.args.get('k', 10))
+            except ValueError as error:
+                response = generate400response(str(error))
+                return response, 400
+
+            if k <= 0 or k > MAX_NEAREST_LOCATIONS:
+                response = generate400response(f"k must be between 1 and {MAX_NEAREST_LOCATIONS}.")
+                return response, 400
+
+            ensure_indexes_ready()
+
+            # Locations holding enough available stock, qty - reserved, so fully held stock is not routed to.
+            # The qty bound is served by the (product_id, qty) index on balance, as qty is at least the available qty
+            available_qty = {'$subtract': ['$qty', {'$ifNull': ['$reserved', 0]}]}
+            stock = {
+                doc['location_id']: doc for doc in balance_collection.aggregate([
+                    {'$match': {'product_id': product_id, 'qty': {'$gte': min_qty},
+                                '$expr': {'$gte': [available_qty, min_qty]}}},
+                    {'$project': {'_id': 0, 'location_id': 1, 'qty': 1, 'available_qty': available_qty}}
+                ]) if ObjectId.is_valid(doc['location_id'])
+            }
+
+            result_docs = []
+            if stock:
+                # Nearest of those locations, served by the 2dsphere index on locations
+                result_docs = list(read_collection.aggregate([
+                    {'$geoNear': {
+                        'near': point,
+                        'key': 'location',
+                        'distanceField': 'distance',
+                        'spherical': True,
+                        'query': {'_id': {'$in': [ObjectId(location_id) for location_id in stock]}}
+                    }},
+                    {'$limit': k}
+                ]))
+
+            for doc in result_docs:
+                doc['qty'] = stock[str(doc['_id'])]['qty']
+                doc['available_qty'] = stock[str(doc['_id'])]['available_qty']
+
+            # Convert to JSON
+            result = json.loads(json.dumps(
+                result_docs, default=json_util.default))
+
+            return {
+                "status": 200,
+                "message": "Success",
+                "timestamp": getISOtimestamp(),
+                "data": result,
+                "records_count": len(result)
+            }, 200
+
+        except Exception as error:
+            res = generate500response(str(error))
+            return res, 500
+
+
+class Liveness(Resource):
+    def get(self):
+        """Liveness probe, the process is up and serving requests"""
+        return {"status": 200, "message": "Alive", "timestamp": getISOtimestamp()}, 200
+
+
+class Readiness(Resource):
+    def get(self):
+        """Readiness probe, the database is reachable"""
+        checks = {"database": ping_database()}
+        status = 200 if all(checks.values()) else 503
+
+        return {
+            "status": status,
+            "message": "Ready" if status == 200 else "Not Ready",
+            "timestamp": getISOtimestamp(),
+            "checks": checks,
+            "database": database_profile()
+        }, status
+
+
+try:
+    ensure_indexes_ready()
+except Exception as error:
+    logging.warning(f"Could not create indexes: {error}")
+
 app = Flask(__name__)
 api = Api(app)
+init_compression(app)
 
 api.add_resource(Locations, '/', '/<string:location_id>')
+api.add_resource(NearestLocations, '/nearest')
+api.add_resource(LocationImport, '/import')
+api.add_resource(Liveness, '/healthz')
+api.add_resource(Readiness, '/readyz')
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
@@ -0,0 +1,121 @@
+import logging
+import threading
+import time
+
+import requests
+from decouple import config
+
+BALANCE_SERVICE_URL = config("BALANCE_SERVICE_URL", default="http://balance-service")
+BALANCE_SERVICE_CONNECT_TIMEOUT = config("BALANCE_SERVICE_CONNECT_TIMEOUT", default=2.0, cast=float)
+BALANCE_SERVICE_READ_TIMEOUT = config("BALANCE_SERVICE_READ_TIMEOUT", default=5.0, cast=float)
+
+CIRCUIT_BREAKER_FAILURE_THRESHOLD = config("CIRCUIT_BREAKER_FAILURE_THRESHOLD", default=5, cast=int)
+CIRCUIT_BREAKER_RESET_SECONDS = config("CIRCUIT_BREAKER_RESET_SECONDS", default=30.0, cast=float)
+
+
+class BalanceServiceError(Exception):
+    """Raised when the balance service could not be reached or failed to process a request.
+
+    `remaining` holds the part of the movement that still has to be applied when some balance writes
+    already succeeded, so a retry does not apply them twice.
+    """
+
+    def __init__(self, message: str, remaining: dict = None):
+        super().__init__(message)
+        self.remaining = remaining
+
+
+class CircuitOpenError(BalanceServiceError):
+    """Raised without calling the balance service while the circuit breaker is open, `retry_after` is the number
+    of seconds until a trial call is let through."""
+
+    def __init__(self, message: str, retry_after: float = 0.0, remaining: dict = None):
+        super().__init__(message, remaining)
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """A circuit breaker that opens after `failure_threshold` consecutive failures.
+
+    While open every call fails immediately. After `reset_seconds` a single trial call is let through (half open),
+    closing the circuit on success or opening it again on failure.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold: int = CIRCUIT_BREAKER_FAILURE_THRESHOLD,
+                 reset_seconds: float = CIRCUIT_BREAKER_RESET_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow_request(self) -> bool:
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_seconds:
+                self.state = self.HALF_OPEN
+                return True
+
+            return False
+
+    def retry_after(self) -> float:
+        """Seconds until the open circuit lets a trial call through"""
+        with self._lock:
+            if self.state != self.OPEN:
+                return 0.0
+            return max(0.0, self.reset_seconds - (time.monotonic() - self.opened_at))
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    logging.warning("Circuit breaker opened for balance service.")
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+
+class BalanceClient:
+    """HTTP client for the balance service with per call timeouts and a circuit breaker."""
+
+    def __init__(self, url: str = BALANCE_SERVICE_URL, breaker: CircuitBreaker = None):
+        self.url = url
+        self.breaker = breaker or CircuitBreaker()
+        self.session = requests.Session()
+        self.timeout = (BALANCE_SERVICE_CONNECT_TIMEOUT, BALANCE_SERVICE_READ_TIMEOUT)
+
+    def _request(self, method: str, obj: dict, path: str = '') -> requests.Response:
+        if not self.breaker.allow_request():
+            raise CircuitOpenError("Circuit breaker is open, balance service call skipped.",
+                                   self.breaker.retry_after())
+
+        try:
+            res = self.session.request(method, url=f"{self.url}{path}", json=obj, timeout=self.timeout)
+        except requests.RequestException as error:
+            self.breaker.record_failure()
+            raise BalanceServiceError(f"Balance service request failed: {error}")
+
+        # Server errors count towards opening the circuit, client errors are returned to the caller
+        if res.status_code >= 500:
+            self.breaker.record_failure()
+            raise BalanceServiceError(f"Balance service responded with status {res.status_code}.")
+
+        self.breaker.record_success()
+        return res
+
+    def adjust(self, obj: dict) -> requests.Response:
+        """Changes the qty of a product at a location by obj['qty_change'], relative to its current qty"""
+        return self._request('POST', obj, '/adjustments')
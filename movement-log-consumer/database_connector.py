@@ -1,6 +1,24 @@
 import pymongo
 from decouple import config
 
-client = pymongo.MongoClient(config("DB_CONNECTION_STRING"))
+DB_MAX_POOL_SIZE = config("DB_MAX_POOL_SIZE", default=100, cast=int)
+DB_MIN_POOL_SIZE = config("DB_MIN_POOL_SIZE", default=0, cast=int)
+# Bound how long an operation waits for a reachable server so health checks fail fast while the database is down
+client = pymongo.MongoClient(config("DB_CONNECTION_STRING"),
+                             serverSelectionTimeoutMS=config("DB_SERVER_SELECTION_TIMEOUT_MS", default=5000, cast=int),
+                             maxPoolSize=DB_MAX_POOL_SIZE, minPoolSize=DB_MIN_POOL_SIZE)
 balance_db = client["balance"]
 balance_collection = balance_db["balance"]
+
+# Per movement status read by the movement service status endpoint
+movements_db = client["movements"]
+movement_status_collection = movements_db["movement_status"]
+
+
+def ping_database() -> bool:
+    """Checks if the database is reachable"""
+    try:
+        client.admin.command('ping')
+        return True
+    except pymongo.errors.PyMongoError:
+        return False
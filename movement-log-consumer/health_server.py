@@ -0,0 +1,56 @@
+import json
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from decouple import config
+
+from database_connector import ping_database
+
+HEALTH_PORT = config("HEALTH_PORT", default=8080, cast=int)
+
+
+class ConsumerState:
+    """Tracks whether the consumer holds an open broker connection."""
+
+    def __init__(self):
+        self.broker_connected = False
+
+
+state = ConsumerState()
+
+
+class HealthHandler(BaseHTTPRequestHandler):
+    """Serves /healthz (liveness) and /readyz (readiness) for the consumer process."""
+
+    def _respond(self, status: int, body: dict) -> None:
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        if self.path == '/healthz':
+            self._respond(200, {"status": 200, "message": "Alive"})
+
+        elif self.path == '/readyz':
+            checks = {"database": ping_database(), "broker": state.broker_connected}
+            status = 200 if all(checks.values()) else 503
+            self._respond(status, {"status": status, "message": "Ready" if status == 200 else "Not Ready",
+                                   "checks": checks})
+
+        else:
+            self._respond(404, {"status": 404, "message": "Resource Not Found"})
+
+    def log_message(self, format, *args):
+        # Probes are frequent, keep them out of the info log
+        logging.debug(format % args)
+
+
+def start_health_server(port: int = HEALTH_PORT) -> None:
+    """Starts the health endpoints on a daemon thread"""
+    server = ThreadingHTTPServer(('0.0.0.0', port), HealthHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logging.info(f"Health endpoints listening on port {port}")
@@ -1,55 +1,211 @@
 import logging
 import pika
-import requests
+import random
 import time
 import pickle
+from decouple import config
+from balance_client import BalanceClient, BalanceServiceError, CircuitOpenError
 from database_connector import *
+from health_server import start_health_server, state
+from movement_status import APPLIED, FAILED, record_status
+from movement_status import publisher as status_publisher
+from stock_events import check_threshold, publisher
 
 QUEUE_NAME = 'movement_log'
+PARKING_QUEUE_NAME = f'{QUEUE_NAME}.parking'
 
+# Failed movements are retried through delay queues, the n-th retry waits RETRY_BASE_DELAY_MS * 2^n
+MAX_RETRIES = config("MAX_RETRIES", default=5, cast=int)
+RETRY_BASE_DELAY_MS = config("RETRY_BASE_DELAY_MS", default=1000, cast=int)
+PREFETCH_COUNT = config("PREFETCH_COUNT", default=10, cast=int)
+
+RABBITMQ_HOST = config("RABBITMQ_HOST", default="rabbitmq")
+STARTUP_BACKOFF_BASE_SECONDS = config("STARTUP_BACKOFF_BASE_SECONDS", default=0.2, cast=float)
+STARTUP_BACKOFF_MAX_SECONDS = config("STARTUP_BACKOFF_MAX_SECONDS", default=5.0, cast=float)
+
+balance_client = BalanceClient()
+
+
+def retry_delay_ms(attempt: int) -> int:
+    return RETRY_BASE_DELAY_MS * 2 ** attempt
+
+
+def retry_queue_name(attempt: int) -> str:
+    # The delay is part of the name, as a queue cannot be declared again with another ttl. Changing
+    # RETRY_BASE_DELAY_MS declares new queues, the old ones still dead letter what they hold
+    return f'{QUEUE_NAME}.retry.{retry_delay_ms(attempt)}ms'
 
-def main():
-    logging.basicConfig(level=logging.INFO)
-    connection = pika.BlockingConnection(pika.ConnectionParameters(host='rabbitmq'))
-    channel = connection.channel()
 
+def declare_queues(channel) -> None:
+    """Declares the movement queue, one delay queue per retry attempt and the parking queue.
+
+    Delay queues have no consumers, their messages expire after the queue ttl and are dead lettered back to
+    the movement queue through the default exchange.
+    """
     channel.queue_declare(queue=QUEUE_NAME)
 
+    for attempt in range(MAX_RETRIES):
+        channel.queue_declare(queue=retry_queue_name(attempt), arguments={
+            'x-message-ttl': retry_delay_ms(attempt),
+            'x-dead-letter-exchange': '',
+            'x-dead-letter-routing-key': QUEUE_NAME,
+        })
+
+    channel.queue_declare(queue=PARKING_QUEUE_NAME, durable=True)
+
+
+def schedule_retry(channel, data: dict, retry_count: int, error: Exception) -> bool:
+    """Publishes a movement to the next delay queue, or to the parking queue once retries are exhausted.
+    Returns True if the movement was parked.
+    """
+    parked = retry_count >= MAX_RETRIES
+    if parked:
+        queue_name = PARKING_QUEUE_NAME
+        logging.warning(f"Movement failed after {retry_count} retries, parking it. Error: {error}")
+    else:
+        queue_name = retry_queue_name(retry_count)
+        logging.info(f"Movement failed, retry {retry_count + 1} of {MAX_RETRIES} scheduled. Error: {error}")
+
+    properties = pika.BasicProperties(headers={'x-retry-count': retry_count + 1, 'x-last-error': str(error)})
+    channel.basic_publish(exchange='', routing_key=queue_name, body=pickle.dumps(data), properties=properties)
+    return parked
+
+
+def backoff_delay(attempt: int) -> float:
+    """Exponential backoff with full jitter, so restarted consumers do not reconnect in lockstep"""
+    return random.uniform(0, min(STARTUP_BACKOFF_MAX_SECONDS, STARTUP_BACKOFF_BASE_SECONDS * 2 ** attempt))
+
+
+def wait_for_database() -> None:
+    """Blocks until the database answers a ping"""
+    attempt = 0
+    while not ping_database():
+        delay = backoff_delay(attempt)
+        logging.info(f"Database not reachable, retrying in {delay:.2f}s")
+        time.sleep(delay)
+        attempt += 1
+
+
+def connect_to_broker() -> pika.BlockingConnection:
+    """Opens a connection to rabbitmq as soon as it is reachable"""
+    parameters = pika.ConnectionParameters(host=RABBITMQ_HOST, connection_attempts=1, socket_timeout=2)
+    attempt = 0
+    while True:
+        try:
+            return pika.BlockingConnection(parameters)
+        except (pika.exceptions.AMQPConnectionError, OSError):
+            delay = backoff_delay(attempt)
+            logging.info(f"Broker not reachable, retrying in {delay:.2f}s")
+            time.sleep(delay)
+            attempt += 1
+
+
+def consume() -> None:
+    connection = connect_to_broker()
+    try:
+        consume_from(connection)
+    finally:
+        state.broker_connected = False
+        # A channel error leaves the connection open
+        if connection.is_open:
+            try:
+                connection.close()
+            except pika.exceptions.AMQPError:
+                pass
+
+
+def consume_from(connection: pika.BlockingConnection) -> None:
+    channel = connection.channel()
+
+    declare_queues(channel)
+    publisher.bind(channel)
+    status_publisher.bind(channel)
+    channel.basic_qos(prefetch_count=PREFETCH_COUNT)
+
     def callback(ch, method, properties, body):
         logging.info("Received %s" % str(body))
+        retry_count = (properties.headers or {}).get('x-retry-count', 0)
+        data = None
         try:
-            allocate_product(pickle.loads(body))
+            data = pickle.loads(body)
+            allocate_product(data)
+            record_status(data, APPLIED)
+        except CircuitOpenError as error:
+            # The balance service is known to be down, so no movement could be applied. Pause consuming until
+            # the breaker lets a trial call through and put the movement back without using up one of its retries
+            logging.info(f"{error} Pausing for {error.retry_after:.1f}s.")
+            ch.connection.sleep(error.retry_after)
+            ch.basic_publish(exchange='', routing_key=QUEUE_NAME, body=pickle.dumps(error.remaining or data),
+                             properties=properties)
+        except BalanceServiceError as error:
+            # Only the part of the movement that was not applied yet is retried
+            if schedule_retry(ch, error.remaining or data, retry_count, error):
+                record_status(data, FAILED, str(error))
         except Exception as error:
             logging.info(str(error))
+            record_status(data, FAILED, str(error))
+
+        # Acknowledge only once the movement is applied, put back or handed over to a retry queue
+        ch.basic_ack(delivery_tag=method.delivery_tag)
 
-    channel.basic_consume(queue=QUEUE_NAME, on_message_callback=callback, auto_ack=True)
+    channel.basic_consume(queue=QUEUE_NAME, on_message_callback=callback)
 
+    state.broker_connected = True
     logging.info('Waiting for messages...')
     channel.start_consuming()
 
 
-def product_exists_at_location(product_id: str, location_id: str) -> bool:
-    """This function checks if product exists at given location."""
-    filters = {
-        'product_id': product_id,
-        'location_id': location_id
-    }
+def main():
+    logging.basicConfig(level=logging.INFO)
+    start_health_server()
+    wait_for_database()
+
+    while True:
+        try:
+            consume()
+        except pika.exceptions.AMQPConnectionError as error:
+            # Connection to the broker was lost, reconnect and resume consuming
+            logging.warning(f"Lost connection to broker: {error}")
+        except pika.exceptions.AMQPChannelError as error:
+            # The broker closed the channel, e.g. a declare conflicting with an existing queue. Keep retrying
+            # after a pause instead of exiting, the health endpoint reports the consumer as not ready meanwhile
+            logging.error(f"Broker closed the channel: {error}")
+            time.sleep(STARTUP_BACKOFF_MAX_SECONDS)
 
-    result_doc = balance_collection.find_one(filters)
-    if not result_doc:
-        return False
 
-    return True
+class MovementFailedError(Exception):
+    """Raised when a movement cannot be applied to the balance, e.g. when the source location lacks qty"""
 
 
-def get_product_qty(product_id: str, location_id: str) -> int:
-    filters = {
+def adjust_balance(product_id: str, location_id: str, qty_change: int, movement_id: str = None) -> None:
+    """Changes the qty of a product at a location by `qty_change` through the balance service.
+
+    The balance service applies the change relative to the current qty, so movements applied concurrently with
+    reservation commits never overwrite each other. It skips a change whose `movement_id` it already applied,
+    so a movement retried after a timeout, whose first attempt may have gone through, is applied only once.
+    Raises MovementFailedError if it rejects the change.
+    """
+    res = balance_client.adjust({
         'product_id': product_id,
-        'location_id': location_id
-    }
+        'location_id': location_id,
+        'qty_change': qty_change,
+        'movement_id': movement_id
+    })
 
-    result_doc = balance_collection.find_one(filters)
-    return int(result_doc['qty'])
+    if res.status_code == 200:
+        logging.info(f"Movement {movement_id} was already applied to {product_id} at {location_id}.")
+        return
+
+    if res.status_code != 201:
+        try:
+            error = res.json().get('error')
+        except ValueError:
+            error = None
+        raise MovementFailedError(error or f"Failed adjusting qty of {product_id} at {location_id}.")
+
+    body = res.json()
+    logging.info(f"Adjusted qty of {product_id} at {location_id} by {qty_change} to {body['qty']}.")
+    check_threshold(product_id, location_id, body['previous_qty'], body['qty'], body.get('reorder_point'))
 
 
 def allocate_product(data: dict) -> None:
@@ -57,130 +213,33 @@ def allocate_product(data: dict) -> None:
     of movement.
     - if from location is not provided and to location is provided, this means a product is being added to the location
     and vice-versa when from location is provided and to location is not (product being removed).
-    - if both from and to locations are provided, quantity is updated in the overall balance data.
+    - if both from and to locations are provided, quantity is moved from one location to the other.
+
+    The qty leaving from_location must be available there, the balance at to_location is created if needed.
     """
 
     from_location = data['from_location']
     to_location = data['to_location']
     product_id = data['product_id']
     quantity = data['quantity']
+    movement_id = str(data['_id']) if data.get('_id') else None
 
-    BALANCE_SERVICE_URL = f'http://balance-service'
+    # Product moving out of a location
+    if from_location:
+        adjust_balance(product_id, from_location, -quantity, movement_id)
 
     # Product moving into a location
-    if not from_location and to_location:
-        if product_exists_at_location(product_id, to_location):
-            from_location_current_qty = get_product_qty(product_id, to_location)
-
-            final_qty = from_location_current_qty + quantity
-            post_obj = {
-                'product_id': product_id,
-                'location_id': to_location,
-                'qty': final_qty
-            }
-
-            res = requests.put(url=BALANCE_SERVICE_URL, json=post_obj)
-            if res.status_code == 201:
-                logging.info("Successfully incremented qty in balance collection.")
-            else:
-                logging.info("Failed updating record in balance collection.")
-
-        else:
-            # Create new record in balance collection
-            obj = {
-                'product_id': product_id,
-                'location_id': to_location,
-                'qty': quantity
-            }
-
-            res = requests.post(url=BALANCE_SERVICE_URL, json=obj)
-            if res.status_code == 201:
-                logging.info("Successfully created record in balance collection.")
-            else:
-                logging.info("Failed creating record in balance collection.")
-
-    # Product moving out of a location
-    if from_location and not to_location:
-        if product_exists_at_location(product_id, from_location):
-            from_location_current_qty = get_product_qty(product_id, from_location)
-
-            if from_location_current_qty >= quantity:
-                # Decrement quantity
-                final_qty = from_location_current_qty - quantity
-                post_obj = {
-                    'product_id': product_id,
-                    'location_id': from_location,
-                    'qty': final_qty
-                }
-
-                res = requests.put(url=BALANCE_SERVICE_URL, json=post_obj)
-                if res.status_code == 201:
-                    logging.info("Successfully decremented qty in balance collection.")
-                else:
-                    logging.info("Failed updating record in balance collection.")
-
-            else:
-                logging.info("Outgoing movement quantity cannot be greater than existing quantity.")
-
-        else:
-            logging.info("Product not found at given location.")
-
-    # Product being moved between two locations
-    if from_location and to_location:
-        if product_exists_at_location(product_id, from_location):
-            from_location_current_qty = get_product_qty(product_id, from_location)
-
-            if from_location_current_qty >= quantity:
-                from_location_final_qty = from_location_current_qty - quantity
-
-                # Decrement qty in from_location
-                decrement_obj = {
-                    'product_id': product_id,
-                    'location_id': from_location,
-                    'qty': from_location_final_qty
-                }
-                decrement_res = requests.put(url=BALANCE_SERVICE_URL, json=decrement_obj)
-
-                if decrement_res.status_code == 201:
-                    logging.info("successfully decremented qty at from_location")
-
-                    if product_exists_at_location(product_id, to_location):
-                        to_location_current_qty = get_product_qty(product_id, to_location)
-                        to_location_final_qty = to_location_current_qty + quantity
-
-                        increment_obj = {
-                            'product_id': product_id,
-                            'location_id': from_location,
-                            'qty': to_location_final_qty
-                        }
-                        increment_res = requests.put(url=BALANCE_SERVICE_URL, json=increment_obj)
-
-                        if increment_res.status_code == 201:
-                            logging.info("Successfully incremented qty at to_location")
-
-                        else:
-                            logging.info("Failed incrementing qty at to_location")
-
-                    else:
-                        increment_obj = {
-                            'product_id': product_id,
-                            'location_id': from_location,
-                            'qty': quantity
-                        }
-                        increment_res = requests.post(url=BALANCE_SERVICE_URL, json=increment_obj)
-
-                        if increment_res.status_code == 201:
-                            logging.info("Successfully created record in balance collection")
-
-                        else:
-                            logging.info("Failed creating record in balance collection")
-
-                else:
-                    logging.info(
-                        "Failed decrementing qty at from_location. qty at to_location will not be incremented.")
+    if to_location:
+        try:
+            adjust_balance(product_id, to_location, quantity, movement_id)
+        except BalanceServiceError as error:
+            if not from_location:
+                raise
+            # from_location is already decremented, only the increment at to_location is left to retry
+            error.remaining = {**data, 'from_location': ''}
+            raise
 
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.INFO)
-    time.sleep(10)  # Temporary fix to solve connection issue on running docker-compose up
     main()
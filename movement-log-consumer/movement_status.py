@@ -0,0 +1,49 @@
+import json
+import logging
+from datetime import datetime
+
+from database_connector import movement_status_collection
+
+# Fanout exchange notifying movement service instances that the status of a movement changed
+MOVEMENT_STATUS_EXCHANGE = 'movement_status'
+
+APPLIED = 'applied'
+FAILED = 'failed'
+
+
+class StatusPublisher:
+    """Publishes movement status changes on the movement status exchange."""
+
+    def __init__(self):
+        self.channel = None
+
+    def bind(self, channel) -> None:
+        """Declares the exchange on the consumer channel and publishes through it from now on"""
+        channel.exchange_declare(exchange=MOVEMENT_STATUS_EXCHANGE, exchange_type='fanout')
+        self.channel = channel
+
+    def publish(self, event: dict) -> None:
+        if self.channel:
+            self.channel.basic_publish(exchange=MOVEMENT_STATUS_EXCHANGE, routing_key='', body=json.dumps(event))
+
+
+publisher = StatusPublisher()
+
+
+def record_status(data: dict, status: str, error: str = None) -> None:
+    """Stores the final status of a movement and notifies waiting clients. Movements without id are skipped."""
+    movement_id = data.get('_id') if isinstance(data, dict) else None
+    if not movement_id:
+        return
+
+    try:
+        movement_status_collection.replace_one(
+            {'_id': movement_id},
+            {'status': status, 'error': error, 'updated_at': datetime.utcnow()},
+            upsert=True
+        )
+        publisher.publish({'movement_id': str(movement_id), 'status': status})
+
+    except Exception as error:
+        # Clients waiting on the status fall back to reading it once their wait times out
+        logging.warning(f"Failed recording status of movement {movement_id}: {error}")
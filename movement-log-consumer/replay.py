@@ -0,0 +1,261 @@
+"""Replays a movement stream through the consumer apply logic without RabbitMQ and the balance service.
+
+Movements are read from an NDJSON file (one movement per line with product_id, from_location, to_location and
+quantity) or generated with a configurable number of products and locations, whose popularity follows a Zipf
+distribution with exponent --skew (0 picks them uniformly). Each movement is applied with `allocate_product`
+as fast as possible. Balance service calls are answered in process by `LocalBalanceClient`, which runs the
+`adjust` function of ../balance-service/adjustments.py, so the replay needs a checkout of the whole repository,
+against mongomock or a local mongod given with --db-uri.
+mongomock scans the collection on every query, use a local mongod when the database share of the profile matters.
+
+Reports movements per second and the Mongo operations per movement, split into the reads of the consumer and
+the writes done for the balance service. With --profile the run is recorded with cProfile, the stats file can
+be opened with snakeviz or turned into a flamegraph with flameprof. Finally the balances are checked against a
+reference replay of the same stream in plain Python.
+
+Usage: python replay.py [--input movements.ndjson | --movements 10000 --products 1000 --locations 50 --skew 1.1]
+                        [--record movements.ndjson] [--db-uri mongodb://localhost:27017] [--profile replay.prof]
+"""
+import argparse
+import cProfile
+import itertools
+import json
+import logging
+import os
+import pstats
+import random
+import sys
+import time
+from collections import Counter
+
+from bson import ObjectId
+
+# The consumer modules create their database client on import, it never connects since every collection
+# they use is replaced below
+os.environ.setdefault("DB_CONNECTION_STRING", "mongodb://localhost:27017")
+
+import main as consumer
+import movement_status
+
+# Balance calls run the adjustment code of the balance service itself. Its directory is searched last, so the
+# modules both services have, such as main and database_connector, still resolve to the consumer ones
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'balance-service'))
+
+try:
+    import adjustments
+except ImportError:
+    raise SystemExit("balance-service/adjustments.py not found, run the replay from a checkout of the repository.")
+
+REPLAY_DB_NAME = 'balance_replay'
+
+
+class CountingCollection:
+    """Wraps a collection and counts the calls of each of its methods."""
+
+    def __init__(self, collection, counter: Counter):
+        self._collection = collection
+        self._counter = counter
+
+    def __getattr__(self, name):
+        attribute = getattr(self._collection, name)
+        if not callable(attribute):
+            return attribute
+
+        def counted(*args, **kwargs):
+            self._counter[name] += 1
+            return attribute(*args, **kwargs)
+
+        return counted
+
+
+class LocalResponse:
+    def __init__(self, status_code: int, body: dict = None):
+        self.status_code = status_code
+        self.body = body or {}
+
+    def json(self) -> dict:
+        return self.body
+
+
+class LocalBalanceClient:
+    """Answers balance service calls in process with the adjustment code of the balance service."""
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def adjust(self, obj: dict) -> LocalResponse:
+        try:
+            previous_qty, qty, applied, reorder_point = adjustments.adjust(
+                self.collection, obj['product_id'], obj['location_id'], obj['qty_change'], obj.get('movement_id'))
+        except adjustments.BalanceNotFoundError as error:
+            return LocalResponse(400, {'error': str(error)})
+        except adjustments.InsufficientQtyError as error:
+            return LocalResponse(409, {'error': str(error)})
+
+        return LocalResponse(201 if applied else 200, {'previous_qty': previous_qty, 'qty': qty,
+                                                       'reorder_point': reorder_point})
+
+
+def zipf_weights(count: int, skew: float) -> list:
+    return [1 / rank ** skew for rank in range(1, count + 1)]
+
+
+def generate_movements(count: int, products: int, locations: int, skew: float, seed: int):
+    """Yields random incoming, outgoing and between locations movements, incoming ones being the most common
+    so that stock builds up"""
+    rng = random.Random(seed)
+    product_ids = [f'product-{index}' for index in range(products)]
+    location_ids = [f'location-{index}' for index in range(locations)]
+    product_weights = list(itertools.accumulate(zipf_weights(products, skew)))
+    location_weights = list(itertools.accumulate(zipf_weights(locations, skew)))
+
+    for _ in range(count):
+        product_id = rng.choices(product_ids, cum_weights=product_weights)[0]
+        from_location, to_location = rng.choices(location_ids, cum_weights=location_weights, k=2)
+        kind = rng.random()
+
+        if kind < 0.5:
+            from_location = ''
+        elif kind < 0.75:
+            to_location = ''
+        elif from_location == to_location:
+            from_location = ''
+
+        yield {
+            '_id': str(ObjectId()),
+            'product_id': product_id,
+            'from_location': from_location,
+            'to_location': to_location,
+            'quantity': rng.randint(1, 20)
+        }
+
+
+def read_movements(path: str):
+    with open(path) as file:
+        for line in file:
+            if line.strip():
+                yield json.loads(line)
+
+
+def reference_replay(movements: list) -> tuple:
+    """Applies the movements to a dict of balances, returns the balances and the number of rejected movements"""
+    balances = {}
+    rejected = 0
+
+    for data in movements:
+        product_id = data['product_id']
+        from_location = data['from_location']
+        to_location = data['to_location']
+        quantity = data['quantity']
+
+        if from_location:
+            available = balances.get((product_id, from_location))
+            if available is None or available < quantity:
+                rejected += 1
+                continue
+            balances[product_id, from_location] = available - quantity
+
+        if to_location:
+            balances[product_id, to_location] = balances.get((product_id, to_location), 0) + quantity
+
+    return balances, rejected
+
+
+def apply(movements: list) -> int:
+    """Applies the movements the way the consumer callback does, returns the number of rejected movements"""
+    rejected = 0
+    for data in movements:
+        try:
+            consumer.allocate_product(data)
+            movement_status.record_status(data, movement_status.APPLIED)
+        except consumer.MovementFailedError as error:
+            movement_status.record_status(data, movement_status.FAILED, str(error))
+            rejected += 1
+    return rejected
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--input', help="NDJSON file with a captured movement stream")
+    parser.add_argument('--record', help="writes the replayed movements to this NDJSON file")
+    parser.add_argument('--movements', type=int, default=10000)
+    parser.add_argument('--products', type=int, default=1000)
+    parser.add_argument('--locations', type=int, default=50)
+    parser.add_argument('--skew', type=float, default=1.1, help="Zipf exponent of product and location popularity")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--db-uri', help="local mongod to replay against instead of mongomock")
+    parser.add_argument('--profile', help="writes cProfile stats of the replay to this file")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+
+    if args.input:
+        movements = list(read_movements(args.input))
+    else:
+        movements = list(generate_movements(args.movements, args.products, args.locations, args.skew, args.seed))
+
+    if args.record:
+        with open(args.record, 'w') as file:
+            file.writelines(json.dumps(data) + '\n' for data in movements)
+
+    if args.db_uri:
+        import pymongo
+        client = pymongo.MongoClient(args.db_uri)
+    else:
+        try:
+            import mongomock
+        except ImportError:
+            raise SystemExit("mongomock is not installed, install it or pass --db-uri of a local mongod.")
+        client = mongomock.MongoClient()
+
+    db = client[REPLAY_DB_NAME]
+    db['balance'].drop()
+    db['movement_status'].drop()
+    # Same index the balance service creates
+    db['balance'].create_index([('product_id', 1), ('location_id', 1)], unique=True)
+
+    consumer_ops = Counter()
+    balance_service_ops = Counter()
+    consumer_collection = CountingCollection(db['balance'], consumer_ops)
+
+    consumer.balance_collection = consumer_collection
+    movement_status.movement_status_collection = CountingCollection(db['movement_status'], consumer_ops)
+    consumer.balance_client = LocalBalanceClient(CountingCollection(db['balance'], balance_service_ops))
+
+    profile = cProfile.Profile() if args.profile else None
+    started = time.perf_counter()
+    if profile:
+        profile.enable()
+    rejected = apply(movements)
+    if profile:
+        profile.disable()
+    elapsed = time.perf_counter() - started
+
+    count = len(movements)
+    print(f"{count} movements in {elapsed:.2f}s ({count / elapsed:.0f} movements/s"
+          f"{', profiled' if profile else ''}), {rejected} rejected")
+    for name, ops in (('consumer', consumer_ops), ('balance service', balance_service_ops)):
+        breakdown = ', '.join(f"{method} {calls / count:.2f}" for method, calls in ops.most_common())
+        print(f"{name} mongo ops/movement: {sum(ops.values()) / count:.2f} ({breakdown})")
+
+    if profile:
+        profile.dump_stats(args.profile)
+        pstats.Stats(args.profile).sort_stats('cumulative').print_stats(15)
+        print(f"profile written to {args.profile}")
+
+    expected, expected_rejected = reference_replay(movements)
+    actual = {(doc['product_id'], doc['location_id']): doc['qty'] for doc in db['balance'].find()}
+    mismatches = [(key, expected.get(key), actual.get(key)) for key in expected.keys() | actual.keys()
+                  if expected.get(key) != actual.get(key)]
+
+    print(f"balances: {len(actual)}, mismatching balances: {len(mismatches)}, "
+          f"rejected movements: {rejected} (reference {expected_rejected})")
+    for (product_id, location_id), expected_qty, actual_qty in mismatches[:10]:
+        print(f"  {product_id} at {location_id}: expected {expected_qty}, got {actual_qty}")
+
+    if mismatches or rejected != expected_rejected:
+        raise SystemExit("Replay does not match the reference replay.")
+
+
+if __name__ == "__main__":
+    main()
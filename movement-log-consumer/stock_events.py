@@ -0,0 +1,67 @@
+import json
+import logging
+from datetime import datetime
+
+import pika
+
+STOCK_EVENTS_EXCHANGE = 'stock_events'
+LOW_STOCK_ROUTING_KEY = 'stock.low'
+RESTORED_ROUTING_KEY = 'stock.restored'
+
+
+class StockEventPublisher:
+    """Publishes low stock and restored events on the stock events exchange."""
+
+    def __init__(self):
+        self.channel = None
+
+    def bind(self, channel) -> None:
+        """Declares the exchange on the consumer channel and publishes through it from now on"""
+        channel.exchange_declare(exchange=STOCK_EVENTS_EXCHANGE, exchange_type='topic', durable=True)
+        self.channel = channel
+
+    def publish(self, routing_key: str, event: dict) -> None:
+        if not self.channel:
+            logging.warning(f"No broker channel, dropping {routing_key} event: {event}")
+            return
+
+        self.channel.basic_publish(exchange=STOCK_EVENTS_EXCHANGE, routing_key=routing_key,
+                                   body=json.dumps(event),
+                                   properties=pika.BasicProperties(content_type='application/json',
+                                                                   delivery_mode=2))
+        logging.info(f"Published {routing_key} event: {event}")
+
+
+publisher = StockEventPublisher()
+
+
+def check_threshold(product_id: str, location_id: str, old_qty: int, new_qty: int, reorder_point) -> None:
+    """Publishes an event if a qty change crosses the reorder point of the balance it was applied to.
+
+    The reorder point is returned by the balance service with the adjusted qty, so no extra read is needed and
+    the work per movement does not depend on the number of balances.
+    """
+    if reorder_point is None:
+        return
+
+    if old_qty > reorder_point >= new_qty:
+        routing_key = LOW_STOCK_ROUTING_KEY
+    elif old_qty <= reorder_point < new_qty:
+        routing_key = RESTORED_ROUTING_KEY
+    else:
+        return
+
+    event = {
+        'product_id': product_id,
+        'location_id': location_id,
+        'qty': new_qty,
+        'previous_qty': old_qty,
+        'reorder_point': reorder_point,
+        'timestamp': datetime.now().isoformat()
+    }
+
+    # The balance is already updated, a failed event must not interrupt the rest of the movement
+    try:
+        publisher.publish(routing_key, event)
+    except Exception as error:
+        logging.warning(f"Failed publishing {routing_key} event {event}: {error}")
@@ -0,0 +1,158 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import pika
+from decouple import Csv, config
+
+RABBITMQ_HOST = config("RABBITMQ_HOST", default="rabbitmq")
+BROKER_SOCKET_TIMEOUT_SECONDS = config("BROKER_SOCKET_TIMEOUT_SECONDS", default=2.0, cast=float)
+
+# Queue depth thresholds. Above the soft limit (per active consumer) new movements are rejected with 429,
+# above the hard limit (total backlog) they are rejected with 503.
+QUEUE_DEPTH_SOFT_LIMIT = config("QUEUE_DEPTH_SOFT_LIMIT", default=5000, cast=int)
+QUEUE_DEPTH_HARD_LIMIT = config("QUEUE_DEPTH_HARD_LIMIT", default=20000, cast=int)
+QUEUE_STATS_TTL_SECONDS = config("QUEUE_STATS_TTL_SECONDS", default=2.0, cast=float)
+QUEUE_RETRY_AFTER_SECONDS = config("QUEUE_RETRY_AFTER_SECONDS", default=5, cast=int)
+
+# Per client token bucket
+RATE_LIMIT_PER_SECOND = config("RATE_LIMIT_PER_SECOND", default=50.0, cast=float)
+RATE_LIMIT_BURST = config("RATE_LIMIT_BURST", default=100, cast=int)
+RATE_LIMIT_MAX_CLIENTS = config("RATE_LIMIT_MAX_CLIENTS", default=10000, cast=int)
+
+# Addresses of reverse proxies whose X-Forwarded-For header is trusted to name the client
+TRUSTED_PROXIES = config("TRUSTED_PROXIES", default="", cast=Csv())
+
+
+def broker_parameters() -> pika.ConnectionParameters:
+    """Connection parameters failing fast while the broker is down, so requests do not block on it"""
+    return pika.ConnectionParameters(host=RABBITMQ_HOST, connection_attempts=1,
+                                     socket_timeout=BROKER_SOCKET_TIMEOUT_SECONDS)
+
+
+class QueueStats:
+    """Caches the depth and consumer count of a queue obtained through a passive declare."""
+
+    def __init__(self, queue_name: str, ttl: float = QUEUE_STATS_TTL_SECONDS):
+        self.queue_name = queue_name
+        self.ttl = ttl
+        self.message_count = 0
+        self.consumer_count = 0
+        self._fetched_at = 0.0
+        self._lock = threading.Lock()
+
+    def _fetch(self) -> None:
+        connection = pika.BlockingConnection(broker_parameters())
+        try:
+            channel = connection.channel()
+            # Passive declare only inspects the queue, it does not create or modify it
+            frame = channel.queue_declare(queue=self.queue_name, passive=True)
+            self.message_count = frame.method.message_count
+            self.consumer_count = frame.method.consumer_count
+        finally:
+            connection.close()
+
+    def refresh(self) -> None:
+        """Refreshes the cached values if they are older than the ttl. Only one thread refreshes at a time."""
+        if time.monotonic() - self._fetched_at < self.ttl:
+            return
+
+        if not self._lock.acquire(blocking=False):
+            # Another thread is already refreshing, serve the cached values
+            return
+
+        try:
+            self._fetch()
+        except Exception as error:
+            # Queue may not exist yet or broker is unreachable, fail open and let publishing surface the error
+            logging.warning(f"Could not fetch stats for {self.queue_name} queue: {error}")
+            self.message_count = 0
+            self.consumer_count = 0
+        finally:
+            self._fetched_at = time.monotonic()
+            self._lock.release()
+
+    @property
+    def lag_per_consumer(self) -> int:
+        """Number of messages waiting for each active consumer, the whole backlog if no consumer is attached."""
+        return self.message_count // max(self.consumer_count, 1)
+
+
+class TokenBucket:
+    """A token bucket refilled continuously at `rate` tokens per second up to `capacity` tokens."""
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated_at = time.monotonic()
+
+    def consume(self, now: float) -> float:
+        """Takes a token from the bucket. Returns 0 on success, otherwise seconds until a token is available."""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+
+        return (1 - self.tokens) / self.rate
+
+
+class RateLimiter:
+    """Keeps a token bucket per client, for at most `max_clients` clients.
+
+    Beyond that the least recently seen client is dropped, so rotating client addresses cannot grow memory.
+    A dropped client starts over with a full bucket.
+    """
+
+    def __init__(self, rate: float = RATE_LIMIT_PER_SECOND, burst: int = RATE_LIMIT_BURST,
+                 max_clients: int = RATE_LIMIT_MAX_CLIENTS):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def acquire(self, client_id: str) -> float:
+        """Returns 0 if the client may proceed, otherwise the number of seconds it should wait."""
+        now = time.monotonic()
+
+        with self._lock:
+            bucket = self._buckets.get(client_id)
+
+            if bucket is None:
+                while len(self._buckets) >= self.max_clients:
+                    self._buckets.popitem(last=False)
+
+                bucket = TokenBucket(self.rate, self.burst)
+                self._buckets[client_id] = bucket
+            else:
+                self._buckets.move_to_end(client_id)
+
+            return bucket.consume(now)
+
+
+class AdmissionController:
+    """Decides whether a new movement is accepted based on the client rate and the movement queue backlog."""
+
+    def __init__(self, queue_name: str):
+        self.queue_stats = QueueStats(queue_name)
+        self.rate_limiter = RateLimiter()
+
+    def check(self, client_id: str):
+        """Returns None if the request is admitted, otherwise a tuple of (status code, error, retry after seconds)."""
+        wait = self.rate_limiter.acquire(client_id)
+        if wait:
+            return 429, "Rate limit exceeded.", max(1, int(wait + 0.999))
+
+        self.queue_stats.refresh()
+
+        if self.queue_stats.message_count >= QUEUE_DEPTH_HARD_LIMIT:
+            return 503, "Movement queue is full, try again later.", QUEUE_RETRY_AFTER_SECONDS
+
+        if self.queue_stats.lag_per_consumer >= QUEUE_DEPTH_SOFT_LIMIT:
+            return 429, "Movement consumer is lagging behind, try again later.", QUEUE_RETRY_AFTER_SECONDS
+
+        return None
@@ -0,0 +1,111 @@
+"""Benchmarks movement ingestion and balance writes under each durability profile.
+
+For every profile, many threads insert movements and increment a few balances in a separate benchmark database
+on the cluster configured by DB_CONNECTION_STRING, using the write concern of the profile. The fast profile
+runs with its background journal flush. Reports writes per second and the p50 and p99 latency of each kind of
+write. The strict profile needs a replica set to show the cost of majority acknowledgement.
+
+Usage: python benchmark_durability.py [--profiles default,fast,strict] [--threads 32] [--writes 20000] [--skus 100]
+"""
+import argparse
+import random
+import threading
+import time
+from datetime import datetime
+
+import pymongo
+from bson import ObjectId
+from decouple import config
+
+from database_connector import WRITE_CONCERNS, JournalFlusher, write_listener
+
+BENCHMARK_DB_NAME = config("BENCHMARK_DB_NAME", default="movement_benchmark")
+
+
+def percentile(latencies: list, fraction: float) -> float:
+    return latencies[min(len(latencies) - 1, int(len(latencies) * fraction))]
+
+
+def run_profile(client, profile: str, threads: int, writes: int, skus: int) -> None:
+    db = client.get_database(BENCHMARK_DB_NAME, write_concern=WRITE_CONCERNS[profile])
+    movements_collection = db["movements"]
+    balance_collection = db["balance"]
+
+    movements_collection.drop()
+    balance_collection.drop()
+    balance_collection.insert_many([{'product_id': f'product-{sku}', 'location_id': 'benchmark', 'qty': 0}
+                                    for sku in range(skus)])
+
+    flusher = JournalFlusher(db) if profile == 'fast' else None
+    if flusher:
+        flusher.start()
+
+    ingest_latencies = [[] for _ in range(threads)]
+    balance_latencies = [[] for _ in range(threads)]
+
+    def worker(index: int) -> None:
+        rng = random.Random(index)
+        for _ in range(writes // threads):
+            product_id = f'product-{rng.randrange(skus)}'
+
+            started = time.perf_counter()
+            movements_collection.insert_one({
+                '_id': ObjectId(),
+                'product_id': product_id,
+                'from_location': '',
+                'to_location': 'benchmark',
+                'quantity': 1,
+                'timestamp': datetime.utcnow()
+            })
+            ingest_latencies[index].append(time.perf_counter() - started)
+
+            started = time.perf_counter()
+            balance_collection.update_one({'product_id': product_id, 'location_id': 'benchmark'},
+                                          {'$inc': {'qty': 1}})
+            balance_latencies[index].append(time.perf_counter() - started)
+
+    workers = [threading.Thread(target=worker, args=(index,)) for index in range(threads)]
+    started = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    if flusher:
+        flusher.stop()
+
+    for name, latencies in (('ingest', ingest_latencies), ('balance', balance_latencies)):
+        latencies = sorted(latency for thread_latencies in latencies for latency in thread_latencies)
+        print(f"{profile:<8}{name:<9}{len(latencies) / elapsed:>12.0f}{percentile(latencies, 0.5) * 1000:>10.2f}"
+              f"{percentile(latencies, 0.99) * 1000:>10.2f}")
+
+    expected = (writes // threads) * threads
+    applied = sum(doc['qty'] for doc in balance_collection.find())
+    if movements_collection.count_documents({}) != expected or applied != expected:
+        raise SystemExit(f"Consistency check failed for the {profile} profile.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--profiles', default=','.join(WRITE_CONCERNS))
+    parser.add_argument('--threads', type=int, default=32)
+    parser.add_argument('--writes', type=int, default=20000, help="movements inserted per profile")
+    parser.add_argument('--skus', type=int, default=100, help="number of balances the increments are spread over")
+    args = parser.parse_args()
+
+    profiles = args.profiles.split(',')
+    unknown = [profile for profile in profiles if profile not in WRITE_CONCERNS]
+    if unknown:
+        raise SystemExit(f"Unknown profiles: {', '.join(unknown)}.")
+
+    client = pymongo.MongoClient(config("DB_CONNECTION_STRING"), maxPoolSize=args.threads,
+                                 event_listeners=[write_listener])
+
+    print(f"{'profile':<8}{'write':<9}{'writes/s':>12}{'p50 ms':>10}{'p99 ms':>10}")
+    for profile in profiles:
+        run_profile(client, profile, args.threads, args.writes, args.skus)
+
+
+if __name__ == "__main__":
+    main()
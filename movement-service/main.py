@@ -1,17 +1,26 @@
 import json
 import logging
 import pickle
-from datetime import datetime
+import random
+import time
+from datetime import datetime, timezone
 
 import pika
 from bson import json_util, ObjectId
 from flask import Flask, request
 from flask_restful import Api, Resource
 
-from database_connector import collection
+from admission_control import AdmissionController, TRUSTED_PROXIES, broker_parameters
+from compression import init_compression
+from database_connector import collection, database_profile, ping_database, start_journal_flusher
+from movement_status import MAX_STATUS_WAIT_SECONDS, PENDING, UNKNOWN, start_status_listener, status_expired
+from movement_status import wait_for_status
+from movement_storage import find_movement, find_movements, start_compactor
 
 QUEUE_NAME = 'movement_log'
 
+admission_controller = AdmissionController(QUEUE_NAME)
+
 
 def getISOtimestamp() -> str:
     """ A function that generates ISO 8601 timestamp """
@@ -37,12 +46,68 @@ def generate500response(error: str) -> dict:
     }
 
 
+def generate429response(error: str) -> dict:
+    """ A function that generates a '429-Too Many Requests' message """
+    return {
+        "status": 429,
+        "message": "Too Many Requests",
+        "error": error
+    }
+
+
+def generate503response(error: str) -> dict:
+    """ A function that generates a '503-Service Unavailable' message """
+    return {
+        "status": 503,
+        "message": "Service Unavailable",
+        "error": error
+    }
+
+
+def get_client_id() -> str:
+    """Identifies the client for rate limiting by its address.
+
+    X-Forwarded-For is only read when the request comes from a trusted proxy. Each proxy appends the address it
+    received the request from, so the last address not belonging to a trusted proxy is the client. Addresses
+    before it are supplied by the client and cannot be trusted.
+    """
+    client_id = request.remote_addr
+    if client_id not in TRUSTED_PROXIES:
+        return client_id
+
+    forwarded_for = request.headers.get('X-Forwarded-For', '')
+    for address in reversed([address.strip() for address in forwarded_for.split(',') if address.strip()]):
+        client_id = address
+        if address not in TRUSTED_PROXIES:
+            break
+
+    return client_id
+
+
+def parse_utc_datetime(value: str):
+    """Parses an optional ISO 8601 timestamp into a naive UTC datetime, timestamps without offset are taken as UTC"""
+    if not value:
+        return None
+
+    # fromisoformat does not accept the Z suffix before Python 3.11
+    date = datetime.fromisoformat(value[:-1] + '+00:00' if value.endswith('Z') else value)
+    if date.tzinfo:
+        date = date.astimezone(timezone.utc).replace(tzinfo=None)
+
+    return date
+
+
+# Existence checks read from the primary of the catalog services, so a product or location created a moment ago is
+# found even when their GETs are served by lagging secondaries
+READ_PRIMARY_HEADERS = {"X-Read-Primary": "true"}
+
+
 def location_exists(location_id: str) -> bool:
     """This function checks if location id exists by making a GET request to the location service."""
     import requests
     URL = f"http://location-service/{location_id}"
 
-    res = requests.get(URL)
+    res = requests.get(URL, headers=READ_PRIMARY_HEADERS)
     if res.status_code != 200:
         return False
 
@@ -54,18 +119,40 @@ def product_exists(product_id: str) -> bool:
     import requests
     URL = f"http://product-service/{product_id}"
 
-    res = requests.get(URL)
+    res = requests.get(URL, headers=READ_PRIMARY_HEADERS)
     if res.status_code != 200:
         return False
 
     return True
 
 
+def connect_to_broker(attempts: int = 3, base_delay: float = 0.1, max_delay: float = 2.0) -> pika.BlockingConnection:
+    """Opens a connection to rabbitmq, retrying with exponential backoff and full jitter"""
+    # Setup connection with rabbitmq service name defined in docker compose file
+    parameters = broker_parameters()
+
+    for attempt in range(attempts):
+        try:
+            return pika.BlockingConnection(parameters)
+        except (pika.exceptions.AMQPConnectionError, OSError):
+            if attempt == attempts - 1:
+                raise
+            time.sleep(random.uniform(0, min(max_delay, base_delay * 2 ** attempt)))
+
+
+def broker_reachable() -> bool:
+    """Checks if a connection to rabbitmq can be opened"""
+    try:
+        connect_to_broker(attempts=1).close()
+        return True
+    except (pika.exceptions.AMQPError, OSError):
+        return False
+
+
 def publish_message(message: dict, queue_name: str) -> None:
     """A function that publishes a message body of type dict to a rabbitmq queue"""
 
-    # Setup connection with rabbitmq service name defined in docker compose file
-    connection = pika.BlockingConnection(pika.ConnectionParameters(host='rabbitmq'))
+    connection = connect_to_broker()
     channel = connection.channel()
 
     channel.queue_declare(queue=queue_name)
@@ -85,8 +172,19 @@ class Movements(Resource):
             if movement_id:
                 filters.update({'_id': ObjectId(movement_id)})
 
-            # Get movements documents from collection as list
-            result_docs = list(collection.find(filters))
+                movement = find_movement(filters['_id'])
+                result_docs = [movement] if movement else []
+
+            else:
+                try:
+                    start = parse_utc_datetime(request.args.get('start'))
+                    end = parse_utc_datetime(request.args.get('end'))
+                except ValueError:
+                    response = generate400response("start and end must be ISO 8601 timestamps.")
+                    return response, 400
+
+                # Get movements documents of the raw, bucketed and archived layouts as list
+                result_docs = find_movements(request.args.get('product_id'), start, end)
 
             # Convert to JSON
             result = json.loads(json.dumps(
@@ -115,6 +213,16 @@ class Movements(Resource):
     def post(self):
         """RESTful POST method"""
         try:
+            # Reject early when the client exceeds its rate or the consumer is falling behind
+            rejection = admission_controller.check(get_client_id())
+            if rejection:
+                status, error, retry_after = rejection
+                if status == 429:
+                    response = generate429response(error)
+                else:
+                    response = generate503response(error)
+                return response, status, {'Retry-After': str(retry_after)}
+
             data = request.get_json()
 
             from_location = data['from_location']
@@ -182,10 +290,96 @@ class Movements(Resource):
             return response, 500
 
 
+class MovementStatus(Resource):
+    def get(self, movement_id: str):
+        """RESTful GET method returning whether a movement was applied to the balance.
+        With `wait` set, waits up to that many seconds for the movement to be processed.
+        """
+        try:
+            if not ObjectId.is_valid(movement_id):
+                response = generate400response("movement_id is not a valid id.")
+                return response, 400
+
+            try:
+                wait = float(request.args.get('wait', 0))
+            except ValueError:
+                response = generate400response("wait must be a number of seconds.")
+                return response, 400
+
+            wait = min(max(wait, 0), MAX_STATUS_WAIT_SECONDS)
+            status = wait_for_status(ObjectId(movement_id), wait)
+
+            if not status:
+                if not find_movement(ObjectId(movement_id)):
+                    return {
+                               "status": 404,
+                               "timestamp": getISOtimestamp(),
+                               "message": "Resource Not Found",
+                           }, 404
+
+                # Status records expire, an old movement without one may have been processed long ago
+                status = {'status': UNKNOWN if status_expired(ObjectId(movement_id)) else PENDING, 'error': None}
+
+            return {
+                       "status": 200,
+                       "message": "Success",
+                       "timestamp": getISOtimestamp(),
+                       "data": {
+                           "movement_id": movement_id,
+                           "status": status['status'],
+                           "error": status.get('error')
+                       }
+                   }, 200
+
+        except Exception as error:
+            res = generate500response(str(error))
+            return res, 500
+
+
+class Liveness(Resource):
+    def get(self):
+        """Liveness probe, the process is up and serving requests"""
+        return {"status": 200, "message": "Alive", "timestamp": getISOtimestamp()}, 200
+
+
+class Readiness(Resource):
+    def get(self):
+        """Readiness probe, the database and message broker are reachable"""
+        checks = {"database": ping_database(), "broker": broker_reachable()}
+        status = 200 if all(checks.values()) else 503
+
+        return {
+            "status": status,
+            "message": "Ready" if status == 200 else "Not Ready",
+            "timestamp": getISOtimestamp(),
+            "checks": checks,
+            "database": database_profile()
+        }, status
+
+
+try:
+    start_status_listener()
+except Exception as error:
+    logging.warning(f"Could not start movement status listener: {error}")
+
+try:
+    start_journal_flusher()
+except Exception as error:
+    logging.warning(f"Could not start journal flusher: {error}")
+
+try:
+    start_compactor()
+except Exception as error:
+    logging.warning(f"Could not start movement compactor: {error}")
+
 app = Flask(__name__)
 api = Api(app)
+init_compression(app)
 
 api.add_resource(Movements, '/', '/<string:movement_id>')
+api.add_resource(MovementStatus, '/<string:movement_id>/status')
+api.add_resource(Liveness, '/healthz')
+api.add_resource(Readiness, '/readyz')
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
@@ -0,0 +1,161 @@
+import json
+import logging
+import random
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+import pika
+from decouple import config
+
+from admission_control import RABBITMQ_HOST
+from database_connector import status_collection
+
+# Fanout exchange the movement log consumer publishes status changes on
+MOVEMENT_STATUS_EXCHANGE = 'movement_status'
+MAX_STATUS_WAIT_SECONDS = config("MAX_STATUS_WAIT_SECONDS", default=25, cast=int)
+STATUS_RETENTION_SECONDS = config("STATUS_RETENTION_SECONDS", default=7 * 24 * 3600, cast=int)
+
+# Each waiting request holds a worker thread, beyond this many waiters the current status is returned at once
+MAX_STATUS_WAITERS = config("MAX_STATUS_WAITERS", default=16, cast=int)
+# How often the listener retries creating the status indexes while the database is unreachable
+STATUS_INDEX_RETRY_SECONDS = 30
+
+PENDING = 'pending'
+# The movement is older than the status retention, its status record may have been removed
+UNKNOWN = 'unknown'
+
+waiters = threading.BoundedSemaphore(MAX_STATUS_WAITERS)
+
+
+def ensure_indexes() -> None:
+    """Expires status records once clients no longer need them"""
+    status_collection.create_index('updated_at', expireAfterSeconds=STATUS_RETENTION_SECONDS)
+
+
+def status_expired(movement_id) -> bool:
+    """Checks if a movement was created longer ago than status records are kept"""
+    retention = timedelta(seconds=STATUS_RETENTION_SECONDS)
+    return movement_id.generation_time < datetime.now(timezone.utc) - retention
+
+
+def get_status(movement_id) -> dict:
+    """Returns the recorded status of a movement, None if the consumer has not processed it yet"""
+    return status_collection.find_one({'_id': movement_id})
+
+
+class StatusNotifier:
+    """Wakes up requests waiting on the status of a movement when the consumer announces a change."""
+
+    def __init__(self):
+        self._waiters = {}
+        self._lock = threading.Lock()
+
+    def register(self, movement_id: str) -> threading.Event:
+        event = threading.Event()
+        with self._lock:
+            self._waiters.setdefault(movement_id, []).append(event)
+        return event
+
+    def unregister(self, movement_id: str, event: threading.Event) -> None:
+        with self._lock:
+            events = self._waiters.get(movement_id, [])
+            if event in events:
+                events.remove(event)
+            if not events:
+                self._waiters.pop(movement_id, None)
+
+    def notify(self, movement_id: str) -> None:
+        with self._lock:
+            events = self._waiters.pop(movement_id, [])
+        for event in events:
+            event.set()
+
+
+notifier = StatusNotifier()
+
+
+class StatusListener(threading.Thread):
+    """Background thread consuming status changes through an exclusive queue bound to the status exchange.
+
+    It also creates the status indexes, retrying every STATUS_INDEX_RETRY_SECONDS while the database is
+    unreachable, whether or not the broker is.
+    """
+
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.indexes_ready = False
+
+    def create_indexes(self) -> None:
+        if self.indexes_ready:
+            return
+
+        try:
+            ensure_indexes()
+            self.indexes_ready = True
+        except Exception as error:
+            logging.warning(f"Could not create movement status indexes: {error}")
+
+    def listen(self) -> None:
+        connection = pika.BlockingConnection(pika.ConnectionParameters(host=RABBITMQ_HOST))
+        channel = connection.channel()
+
+        channel.exchange_declare(exchange=MOVEMENT_STATUS_EXCHANGE, exchange_type='fanout')
+        queue_name = channel.queue_declare(queue='', exclusive=True).method.queue
+        channel.queue_bind(exchange=MOVEMENT_STATUS_EXCHANGE, queue=queue_name)
+
+        def callback(ch, method, properties, body):
+            try:
+                notifier.notify(json.loads(body)['movement_id'])
+            except (ValueError, KeyError) as error:
+                logging.warning(f"Invalid movement status message {body}: {error}")
+
+        channel.basic_consume(queue=queue_name, on_message_callback=callback, auto_ack=True)
+        while True:
+            connection.process_data_events(time_limit=STATUS_INDEX_RETRY_SECONDS)
+            self.create_indexes()
+
+    def run(self):
+        attempt = 0
+        while True:
+            self.create_indexes()
+            try:
+                self.listen()
+                attempt = 0
+            except Exception as error:
+                # Waiting requests still return once their wait times out, reconnect with jittered backoff
+                delay = random.uniform(0, min(30, 0.5 * 2 ** attempt))
+                logging.warning(f"Movement status listener disconnected, retrying in {delay:.2f}s: {error}")
+                time.sleep(delay)
+                attempt += 1
+
+
+def wait_for_status(movement_id, wait: float) -> dict:
+    """Returns the status of a movement, waiting up to `wait` seconds for the consumer to process it.
+    Does not wait if MAX_STATUS_WAITERS requests are already waiting.
+    """
+    status = get_status(movement_id)
+    if status or wait <= 0 or status_expired(movement_id):
+        return status
+
+    if not waiters.acquire(blocking=False):
+        return status
+
+    event = notifier.register(str(movement_id))
+    try:
+        # Read again after registering, the status may have been recorded in between
+        status = get_status(movement_id)
+        if status:
+            return status
+
+        event.wait(wait)
+        return get_status(movement_id)
+
+    finally:
+        notifier.unregister(str(movement_id), event)
+        waiters.release()
+
+
+def start_status_listener() -> None:
+    # The listener creates the status indexes itself, retrying while the database is unreachable
+    StatusListener().start()
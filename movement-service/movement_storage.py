@@ -0,0 +1,258 @@
+import glob
+import gzip
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+import pymongo
+from bson import ObjectId, json_util
+from decouple import Choices, config
+
+from database_connector import buckets_collection, collection
+
+# 'raw' keeps one document per movement, 'bucketed' additionally compacts movements into per product, per hour
+# buckets in the background and archives cold buckets to compressed local files
+MOVEMENT_STORAGE_MODE = config("MOVEMENT_STORAGE_MODE", default="raw", cast=Choices(['raw', 'bucketed']))
+
+BUCKET_MAX_MOVEMENTS = config("BUCKET_MAX_MOVEMENTS", default=200, cast=int)
+COMPACTION_INTERVAL_SECONDS = config("COMPACTION_INTERVAL_SECONDS", default=60, cast=int)
+COMPACTION_MIN_AGE_SECONDS = config("COMPACTION_MIN_AGE_SECONDS", default=300, cast=int)
+COMPACTION_BATCH_SIZE = config("COMPACTION_BATCH_SIZE", default=5000, cast=int)
+ARCHIVE_AFTER_DAYS = config("ARCHIVE_AFTER_DAYS", default=30, cast=int)
+# Buckets are deleted once archived, this directory must be on persistent storage (a volume in docker compose)
+ARCHIVE_DIR = config("ARCHIVE_DIR", default="/var/lib/movement-service/archive")
+
+ARCHIVE_HOUR_FORMAT = '%Y%m%d%H'
+
+
+def hour_start(date: datetime) -> datetime:
+    """Start of the hour of a naive UTC datetime"""
+    return date.replace(minute=0, second=0, microsecond=0)
+
+
+def bucket_hour(movement_id: ObjectId) -> datetime:
+    """Start of the hour a movement was created in, taken from the timestamp embedded in its ObjectId"""
+    return hour_start(movement_id.generation_time.replace(tzinfo=None))
+
+
+def ensure_indexes() -> None:
+    """Creates the bucket indexes, one entry per bucket instead of one per movement"""
+    buckets_collection.create_index([('product_id', pymongo.ASCENDING), ('hour', pymongo.ASCENDING)])
+    buckets_collection.create_index([('hour', pymongo.ASCENDING)])
+
+
+def id_range_filter(start: datetime = None, end: datetime = None) -> dict:
+    """Filters movements on creation time through their ObjectIds, which is served by the _id index"""
+    id_filter = {}
+    if start:
+        id_filter['$gte'] = ObjectId.from_datetime(start)
+    if end:
+        id_filter['$lt'] = ObjectId.from_datetime(end)
+
+    return {'_id': id_filter} if id_filter else {}
+
+
+def compact(batch_size: int = COMPACTION_BATCH_SIZE, min_age_seconds: int = COMPACTION_MIN_AGE_SECONDS) -> int:
+    """Moves raw movements older than `min_age_seconds` into buckets, returns the number of moved movements.
+
+    Movements already present in a bucket, e.g. when a previous run stopped before deleting them, are not
+    pushed again.
+    """
+    cutoff = datetime.now(timezone.utc) - timedelta(seconds=min_age_seconds)
+    docs = list(collection.find({'_id': {'$lt': ObjectId.from_datetime(cutoff)}})
+                .sort('_id', pymongo.ASCENDING).limit(batch_size))
+
+    if not docs:
+        return 0
+
+    ids = [doc['_id'] for doc in docs]
+    hours = sorted({bucket_hour(movement_id) for movement_id in ids})
+    already_bucketed = {
+        movement['_id']
+        for bucket in buckets_collection.find({'hour': {'$in': hours}, 'movements._id': {'$in': ids}},
+                                              {'movements._id': 1})
+        for movement in bucket['movements']
+    }
+
+    groups = {}
+    for doc in docs:
+        if doc['_id'] not in already_bucketed:
+            groups.setdefault((doc['product_id'], bucket_hour(doc['_id'])), []).append(doc)
+
+    for (product_id, hour), movements in groups.items():
+        for index in range(0, len(movements), BUCKET_MAX_MOVEMENTS):
+            chunk = movements[index:index + BUCKET_MAX_MOVEMENTS]
+
+            # Fill the open bucket of this product and hour if it has room, otherwise start a new one
+            buckets_collection.update_one(
+                {'product_id': product_id, 'hour': hour, 'count': {'$lte': BUCKET_MAX_MOVEMENTS - len(chunk)}},
+                {'$push': {'movements': {'$each': chunk}}, '$inc': {'count': len(chunk)}},
+                upsert=True
+            )
+
+    collection.delete_many({'_id': {'$in': ids}})
+    return len(ids)
+
+
+def archive_path(hour: datetime, first_bucket_id: ObjectId) -> str:
+    """Path of the archive file of an hour, an hour may be archived in several parts.
+
+    Parts are named after their first bucket, so archiving the same buckets again after a crash that happened
+    before they were deleted overwrites the part instead of adding a second copy of its movements.
+    """
+    return os.path.join(ARCHIVE_DIR, f"movements-{hour.strftime(ARCHIVE_HOUR_FORMAT)}-{first_bucket_id}.ndjson.gz")
+
+
+def archive(after_days: int = ARCHIVE_AFTER_DAYS) -> int:
+    """Writes buckets older than `after_days` to gzip NDJSON files, one per hour, and deletes them.
+    Returns the number of archived buckets.
+    """
+    cutoff = (datetime.now(timezone.utc) - timedelta(days=after_days)).replace(tzinfo=None)
+    hours = buckets_collection.distinct('hour', {'hour': {'$lt': cutoff}})
+    archived = 0
+
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+
+    for hour in sorted(hours):
+        buckets = list(buckets_collection.find({'hour': hour}).sort('_id', pymongo.ASCENDING))
+        path = archive_path(hour, buckets[0]['_id'])
+
+        # Write to a temporary file first so a partially written archive is never read
+        with gzip.open(f"{path}.tmp", 'wt', encoding='utf-8') as archive_file:
+            for bucket in buckets:
+                for movement in bucket['movements']:
+                    archive_file.write(json_util.dumps(movement) + '\n')
+        os.replace(f"{path}.tmp", path)
+
+        buckets_collection.delete_many({'_id': {'$in': [bucket['_id'] for bucket in buckets]}})
+        archived += len(buckets)
+
+    return archived
+
+
+def archive_files(start: datetime = None, end: datetime = None) -> list:
+    """Archive files whose hour overlaps the given time range, oldest first. Times are naive UTC."""
+    paths = []
+    for path in sorted(glob.glob(os.path.join(ARCHIVE_DIR, 'movements-*.ndjson.gz'))):
+        hour = datetime.strptime(os.path.basename(path).split('-')[1], ARCHIVE_HOUR_FORMAT)
+        if start and hour + timedelta(hours=1) <= start:
+            continue
+        if end and hour >= end:
+            continue
+        paths.append(path)
+
+    return paths
+
+
+def read_archive(path: str):
+    with gzip.open(path, 'rt', encoding='utf-8') as archive_file:
+        for line in archive_file:
+            yield json_util.loads(line)
+
+
+def matches(movement: dict, product_id: str = None, start: datetime = None, end: datetime = None) -> bool:
+    if product_id and movement.get('product_id') != product_id:
+        return False
+
+    id_filter = id_range_filter(start, end).get('_id', {})
+    if '$gte' in id_filter and movement['_id'] < id_filter['$gte']:
+        return False
+    if '$lt' in id_filter and movement['_id'] >= id_filter['$lt']:
+        return False
+
+    return True
+
+
+def find_movement(movement_id: ObjectId):
+    """Finds a single movement in the raw collection, the buckets or the archive. Returns None if not found."""
+    movement = collection.find_one({'_id': movement_id})
+    if movement or MOVEMENT_STORAGE_MODE != 'bucketed':
+        return movement
+
+    # The creation hour in the ObjectId narrows the lookup to the buckets of that hour
+    hour = bucket_hour(movement_id)
+    bucket = buckets_collection.find_one({'hour': hour, 'movements._id': movement_id})
+    if bucket:
+        return next(movement for movement in bucket['movements'] if movement['_id'] == movement_id)
+
+    for path in archive_files(hour, hour + timedelta(hours=1)):
+        for movement in read_archive(path):
+            if movement['_id'] == movement_id:
+                return movement
+
+    return None
+
+
+def find_movements(product_id: str = None, start: datetime = None, end: datetime = None) -> list:
+    """Lists movements, optionally of a product and created within [start, end) given as naive UTC times.
+    In bucketed mode archived movements come first, then bucketed and raw movements.
+    """
+    raw_filter = id_range_filter(start, end)
+    if product_id:
+        raw_filter['product_id'] = product_id
+
+    if MOVEMENT_STORAGE_MODE != 'bucketed':
+        return list(collection.find(raw_filter))
+
+    movements = []
+
+    for path in archive_files(start, end):
+        movements.extend(movement for movement in read_archive(path) if matches(movement, product_id, start, end))
+
+    bucket_filter = {}
+    if product_id:
+        bucket_filter['product_id'] = product_id
+    if start or end:
+        # Buckets are selected by hour, movements at the edges of the range are filtered individually
+        bucket_filter['hour'] = {}
+        if start:
+            bucket_filter['hour']['$gte'] = hour_start(start)
+        if end:
+            bucket_filter['hour']['$lt'] = end
+
+    for bucket in buckets_collection.find(bucket_filter).sort([('hour', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)]):
+        movements.extend(movement for movement in bucket['movements'] if matches(movement, product_id, start, end))
+
+    movements.extend(collection.find(raw_filter))
+    return movements
+
+
+class MovementCompactor(threading.Thread):
+    """Background thread that periodically compacts raw movements into buckets and archives cold buckets."""
+
+    def __init__(self, interval: int = COMPACTION_INTERVAL_SECONDS):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.indexes_ready = False
+
+    def run(self):
+        while True:
+            try:
+                # Created here rather than at startup, so they are retried if the database was unreachable then
+                if not self.indexes_ready:
+                    ensure_indexes()
+                    self.indexes_ready = True
+
+                # Keep compacting while full batches are returned, to catch up after a pause
+                while compact() == COMPACTION_BATCH_SIZE:
+                    pass
+
+                archived = archive()
+                if archived:
+                    logging.info(f"Archived {archived} movement buckets.")
+
+            except Exception as error:
+                logging.warning(f"Movement compaction failed: {error}")
+
+            time.sleep(self.interval)
+
+
+def start_compactor() -> None:
+    """Starts background compaction when the bucketed storage mode is enabled"""
+    if MOVEMENT_STORAGE_MODE != 'bucketed':
+        return
+
+    MovementCompactor().start()
+    logging.info("Bucketed movement storage enabled, compactor started.")
@@ -0,0 +1,39 @@
+"""Adds the normalized product name used by prefix search to products created before it was stored on insert.
+
+Usage: python backfill_normalized_names.py
+"""
+import logging
+
+from pymongo import UpdateOne
+
+from database_connector import collection
+from product_search import NORMALIZED_NAME_FIELD, ensure_search_indexes, normalize_name
+
+BATCH_SIZE = 1000
+
+
+def backfill() -> int:
+    """Sets the normalized name on every document missing it, returns the number of updated documents"""
+    updated = 0
+    batch = []
+
+    cursor = collection.find({NORMALIZED_NAME_FIELD: {'$exists': False}}, {'product_name': 1})
+
+    for doc in cursor:
+        batch.append(UpdateOne({'_id': doc['_id']},
+                               {'$set': {NORMALIZED_NAME_FIELD: normalize_name(doc.get('product_name', ''))}}))
+
+        if len(batch) >= BATCH_SIZE:
+            updated += collection.bulk_write(batch, ordered=False).modified_count
+            batch = []
+
+    if batch:
+        updated += collection.bulk_write(batch, ordered=False).modified_count
+
+    return updated
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    ensure_search_indexes(collection)
+    logging.info(f"Backfilled {backfill()} products.")
@@ -0,0 +1,109 @@
+"""Benchmarks product search over a synthetic catalog.
+
+Loads a synthetic catalog (one million products by default) into a separate benchmark database on the cluster
+configured by DB_CONNECTION_STRING, then compares the latency of fetching the whole catalog and filtering it
+on the client, which is what clients do without a search endpoint, against text search, prefix search and
+keyset pagination.
+
+Usage: python benchmark_search.py [--products 1000000] [--queries 200] [--skip-load]
+"""
+import argparse
+import random
+import statistics
+import time
+
+import pymongo
+from decouple import config
+
+from product_search import NORMALIZED_NAME_FIELD, ensure_search_indexes, normalize_name, prefix_search, text_search
+
+BENCHMARK_DB_NAME = config("BENCHMARK_DB_NAME", default="products_benchmark")
+
+ADJECTIVES = ['steel', 'wooden', 'plastic', 'heavy', 'compact', 'industrial', 'portable', 'premium', 'basic',
+              'large', 'small', 'reinforced', 'galvanized', 'electric', 'manual', 'waterproof']
+NOUNS = ['pallet', 'bolt', 'hinge', 'crate', 'shelf', 'drill', 'ladder', 'cable', 'pump', 'valve', 'bracket',
+         'container', 'trolley', 'wrench', 'fastener', 'panel', 'bearing', 'gasket', 'sensor', 'motor']
+INSERT_BATCH_SIZE = 10000
+
+
+def synthetic_product(index: int, rng: random.Random) -> dict:
+    name = f"{rng.choice(ADJECTIVES).title()} {rng.choice(NOUNS).title()} {index:07d}"
+    description = ' '.join(rng.choice(ADJECTIVES + NOUNS) for _ in range(12))
+    return {
+        'product_name': name,
+        'product_description': description,
+        NORMALIZED_NAME_FIELD: normalize_name(name),
+    }
+
+
+def load_catalog(collection, count: int) -> None:
+    rng = random.Random(42)
+    collection.drop()
+
+    started = time.perf_counter()
+    batch = []
+    for index in range(count):
+        batch.append(synthetic_product(index, rng))
+        if len(batch) == INSERT_BATCH_SIZE:
+            collection.insert_many(batch, ordered=False)
+            batch = []
+    if batch:
+        collection.insert_many(batch, ordered=False)
+    print(f"Loaded {count} products in {time.perf_counter() - started:.1f}s")
+
+    started = time.perf_counter()
+    ensure_search_indexes(collection)
+    print(f"Built search indexes in {time.perf_counter() - started:.1f}s")
+
+
+def measure(label: str, func, queries: list) -> None:
+    timings = []
+    for query in queries:
+        started = time.perf_counter()
+        func(query)
+        timings.append((time.perf_counter() - started) * 1000)
+
+    timings.sort()
+    p95 = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+    print(f"{label:<28} n={len(timings):<5} p50={statistics.median(timings):9.2f}ms p95={p95:9.2f}ms")
+
+
+def paginate(collection, search, query: str, pages: int, limit: int) -> None:
+    cursor = None
+    for _ in range(pages):
+        _, cursor = search(collection, query, limit, cursor)
+        if not cursor:
+            break
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--products', type=int, default=1000000)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--skip-load', action='store_true', help="reuse the catalog loaded by a previous run")
+    args = parser.parse_args()
+
+    client = pymongo.MongoClient(config("DB_CONNECTION_STRING"))
+    collection = client[BENCHMARK_DB_NAME]["products"]
+
+    if not args.skip_load:
+        load_catalog(collection, args.products)
+
+    rng = random.Random(7)
+    words = [rng.choice(NOUNS) for _ in range(args.queries)]
+    phrases = [f"{rng.choice(ADJECTIVES)} {rng.choice(NOUNS)}" for _ in range(args.queries)]
+    prefixes = [f"{rng.choice(ADJECTIVES)} {rng.choice(NOUNS)[:2]}" for _ in range(args.queries)]
+
+    # The full scan is orders of magnitude slower, a handful of runs is enough
+    measure("full scan + client filter",
+            lambda word: [doc for doc in collection.find() if word in doc['product_name'].lower()], words[:3])
+    measure("text search (first page)", lambda phrase: text_search(collection, phrase, 20), phrases)
+    measure("prefix search (first page)", lambda prefix: prefix_search(collection, prefix, 20), prefixes)
+    measure("prefix search (10 pages)", lambda prefix: paginate(collection, prefix_search, prefix, 10, 20),
+            prefixes[:args.queries // 4])
+    measure("text search (10 pages)", lambda phrase: paginate(collection, text_search, phrase, 10, 20),
+            phrases[:args.queries // 4])
+
+
+if __name__ == "__main__":
+    main()
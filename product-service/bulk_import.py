@@ -0,0 +1,181 @@
+import csv
+import json
+
+from decouple import config
+from pymongo.errors import BulkWriteError, PyMongoError
+
+IMPORT_CHUNK_SIZE = config("IMPORT_CHUNK_SIZE", default=1000, cast=int)
+
+# Only the first errors are reported row by row, the rest are counted
+MAX_REPORTED_ERRORS = config("IMPORT_MAX_REPORTED_ERRORS", default=1000, cast=int)
+
+CSV_CONTENT_TYPES = ('text/csv', 'application/csv')
+NDJSON_CONTENT_TYPES = ('application/x-ndjson', 'application/ndjson', 'application/jsonl')
+
+
+class ImportDatabaseError(Exception):
+    """Raised when a chunk could not be written, `row_number` is the first row of the chunk."""
+
+    def __init__(self, row_number: int, message: str):
+        super().__init__(message)
+        self.row_number = row_number
+
+
+class ImportStreamError(ValueError):
+    """Raised when the rest of the stream cannot be read, `row_number` is the row that could not be parsed."""
+
+    def __init__(self, row_number: int, message: str):
+        super().__init__(message)
+        self.row_number = row_number
+
+
+def decode_line(line: bytes, line_number: int) -> str:
+    try:
+        # A byte order mark may only start the first line
+        return line.decode('utf-8-sig' if line_number == 1 else 'utf-8')
+    except UnicodeDecodeError as error:
+        raise ImportStreamError(line_number, f"Line is not valid UTF-8: {error}")
+
+
+def iter_lines(stream, chunk_size: int = 64 * 1024):
+    """Yields decoded lines from a binary stream, reading it in chunks instead of loading it whole.
+
+    Lines are decoded one by one, so an invalid line raises ImportStreamError with its line number.
+    """
+    buffer = b''
+    line_number = 0
+
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+
+        buffer += chunk
+        lines = buffer.split(b'\n')
+        buffer = lines.pop()
+
+        for line in lines:
+            line_number += 1
+            yield decode_line(line + b'\n', line_number)
+
+    if buffer:
+        yield decode_line(buffer, line_number + 1)
+
+
+def iter_ndjson_rows(stream):
+    """Yields (line number, row) pairs from a NDJSON stream, row is None if the line is not a JSON object"""
+    for row_number, line in enumerate(iter_lines(stream), start=1):
+        if not line.strip():
+            continue
+
+        try:
+            row = json.loads(line)
+        except ValueError:
+            row = None
+
+        yield row_number, row if isinstance(row, dict) else None
+
+
+def iter_csv_rows(stream):
+    """Yields (row number, row) pairs from a CSV stream with a header line, empty cells are left out"""
+    reader = csv.DictReader(iter_lines(stream))
+    row_number = 0
+
+    try:
+        for row_number, row in enumerate(reader, start=1):
+            yield row_number, {key: value for key, value in row.items() if key and value not in (None, '')}
+
+    except (csv.Error, ImportStreamError) as error:
+        # Rows are numbered after the header, not by line
+        raise ImportStreamError(row_number + 1, str(error))
+
+
+def iter_rows(stream, content_type: str):
+    """Picks the parser for the request content type, raises ValueError if it is not supported"""
+    mimetype = (content_type or '').split(';')[0].strip().lower()
+
+    if mimetype in CSV_CONTENT_TYPES:
+        return iter_csv_rows(stream)
+
+    if mimetype in NDJSON_CONTENT_TYPES:
+        return iter_ndjson_rows(stream)
+
+    raise ValueError("Content-Type must be text/csv or application/x-ndjson.")
+
+
+class ImportReport:
+    """Counts inserted rows and collects per row errors."""
+
+    def __init__(self):
+        self.inserted_count = 0
+        self.error_count = 0
+        self.errors = []
+        # Row at which the stream could not be read any further, rows before it were processed
+        self.failed_row = None
+        # Set if the import stopped on a database failure at failed_row instead
+        self.database_error = None
+
+    def add_error(self, row_number: int, error: str) -> None:
+        self.error_count += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({"row": row_number, "error": error})
+
+
+def insert_chunk(collection, chunk: list, report: ImportReport) -> None:
+    """Inserts (row number, document) pairs with a single unordered insert_many, recording failed rows"""
+    try:
+        result = collection.insert_many([doc for _, doc in chunk], ordered=False)
+        report.inserted_count += len(result.inserted_ids)
+
+    except BulkWriteError as error:
+        details = error.details
+        report.inserted_count += details.get('nInserted', 0)
+        for write_error in details.get('writeErrors', []):
+            report.add_error(chunk[write_error['index']][0], write_error.get('errmsg', 'Insert failed.'))
+
+    except PyMongoError as error:
+        # E.g. a connection error or timeout, some rows of the chunk may have been inserted
+        raise ImportDatabaseError(chunk[0][0], str(error))
+
+
+def import_rows(collection, rows, prepare) -> ImportReport:
+    """Validates rows with `prepare` and inserts valid ones in chunks of IMPORT_CHUNK_SIZE.
+
+    `prepare` takes a row, may update it in place and returns an error message if the row is invalid.
+    If the stream cannot be read any further the import stops, the rows before the failed row are still
+    inserted and the failed row is recorded in `failed_row`. If a chunk cannot be written the import stops too,
+    `failed_row` is then the first row of that chunk and `database_error` the failure. Rows before it were
+    processed, rows of that chunk may be partly inserted.
+    """
+    report = ImportReport()
+    chunk = []
+
+    try:
+        try:
+            for row_number, row in rows:
+                if row is None:
+                    report.add_error(row_number, "Row is not a valid JSON object.")
+                    continue
+
+                error = prepare(row)
+                if error:
+                    report.add_error(row_number, error)
+                    continue
+
+                chunk.append((row_number, row))
+                if len(chunk) >= IMPORT_CHUNK_SIZE:
+                    insert_chunk(collection, chunk, report)
+                    chunk = []
+
+        except ImportStreamError as error:
+            report.failed_row = error.row_number
+            report.add_error(error.row_number, str(error))
+
+        if chunk:
+            insert_chunk(collection, chunk, report)
+
+    except ImportDatabaseError as error:
+        report.failed_row = error.row_number
+        report.database_error = str(error)
+
+    return report
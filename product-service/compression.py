@@ -0,0 +1,112 @@
+import zlib
+
+from decouple import config
+from flask import request
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSION_ENABLED = config("COMPRESSION_ENABLED", default=True, cast=bool)
+COMPRESSION_MIN_SIZE = config("COMPRESSION_MIN_SIZE", default=1024, cast=int)
+COMPRESSION_GZIP_LEVEL = config("COMPRESSION_GZIP_LEVEL", default=6, cast=int)
+COMPRESSION_ZSTD_LEVEL = config("COMPRESSION_ZSTD_LEVEL", default=3, cast=int)
+
+COMPRESSIBLE_MIMETYPES = ('application/json', 'application/x-ndjson', 'text/plain', 'text/csv', 'text/html')
+
+# Preferred first when the client accepts several with the same weight, zstd is faster at a similar ratio
+SUPPORTED_ENCODINGS = ('zstd', 'gzip') if zstandard else ('gzip',)
+
+
+def parse_accept_encoding(header: str) -> dict:
+    """Parses an Accept-Encoding header into a mapping of encoding to its q-value"""
+    weights = {}
+    for part in (header or '').split(','):
+        params = part.strip().split(';')
+        encoding = params[0].strip().lower()
+        if not encoding:
+            continue
+
+        weight = 1.0
+        for param in params[1:]:
+            key, _, value = param.strip().partition('=')
+            if key == 'q':
+                try:
+                    weight = float(value)
+                except ValueError:
+                    weight = 0.0
+        weights[encoding] = weight
+
+    return weights
+
+
+def negotiate_encoding(header: str):
+    """Picks the supported encoding with the highest weight the client accepts, None if there is none"""
+    weights = parse_accept_encoding(header)
+    best, best_weight = None, 0.0
+
+    for encoding in SUPPORTED_ENCODINGS:
+        weight = weights.get(encoding, weights.get('*', 0.0))
+        if weight > best_weight:
+            best, best_weight = encoding, weight
+
+    return best
+
+
+def compressor(encoding: str):
+    """Returns an incremental compressor object with `compress` and `flush` methods"""
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor(level=COMPRESSION_ZSTD_LEVEL).compressobj()
+
+    # wbits 31 writes the gzip header and trailer
+    return zlib.compressobj(COMPRESSION_GZIP_LEVEL, zlib.DEFLATED, 31)
+
+
+def compress_stream(chunks, encoding: str):
+    """Compresses a streamed response chunk by chunk"""
+    compressobj = compressor(encoding)
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode()
+        data = compressobj.compress(chunk)
+        if data:
+            yield data
+    yield compressobj.flush()
+
+
+def compress_response(response):
+    """Compresses the response body with the encoding negotiated from the Accept-Encoding request header"""
+    response.vary.add('Accept-Encoding')
+
+    if (response.status_code < 200 or response.status_code in (204, 304)
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+        return response
+
+    encoding = negotiate_encoding(request.headers.get('Accept-Encoding'))
+    if not encoding:
+        return response
+
+    if response.is_streamed:
+        # Size is not known up front, compress as the body is produced
+        response.direct_passthrough = False
+        response.response = compress_stream(response.response, encoding)
+        response.headers.pop('Content-Length', None)
+
+    else:
+        body = response.get_data()
+        if len(body) < COMPRESSION_MIN_SIZE:
+            return response
+
+        compressobj = compressor(encoding)
+        response.set_data(compressobj.compress(body) + compressobj.flush())
+
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
+def init_compression(app) -> None:
+    """Registers response compression on a Flask app"""
+    if COMPRESSION_ENABLED:
+        app.after_request(compress_response)
@@ -2,9 +2,14 @@ import logging
 from flask_restful import Api, Resource
 from flask import Flask, request
 from datetime import datetime
-from database_connector import collection
+from compression import init_compression
+from database_connector import READ_PRIMARY_HEADER, collection, database_profile, ping_database, read_collection
+from database_connector import read_primary_requested
 import json
 from bson import json_util, ObjectId
+from bulk_import import import_rows, iter_rows
+from product_search import (MAX_SEARCH_LIMIT, NORMALIZED_NAME_FIELD, ensure_search_indexes, normalize_name,
+                            prefix_search, text_search)
 
 
 def getISOtimestamp() -> str:
@@ -31,6 +36,18 @@ def generate500response(error: str) -> dict:
     }
 
 
+def prepare_product(data: dict) -> str:
+    """Validates a new product and adds derived fields, returns an error message if the product is invalid"""
+    if not data.get('product_name'):
+        return "product_name key required."
+
+    if not data.get('product_description'):
+        return "product_description key required."
+
+    # Keep a normalized copy of the name for prefix search
+    data[NORMALIZED_NAME_FIELD] = normalize_name(data['product_name'])
+
+
 class Products(Resource):
     def get(self, product_id: str = None):
         """RESTful GET method"""
@@ -41,8 +58,17 @@ class Products(Resource):
             if product_id:
                 filters.update({'_id': ObjectId(product_id)})
 
+            # Read from the primary when the caller asks for it, e.g. to check a product that was just created
+            try:
+                read_primary = read_primary_requested(request.headers.get(READ_PRIMARY_HEADER))
+            except ValueError as error:
+                response = generate400response(str(error))
+                return response, 400
+
+            source = collection if read_primary else read_collection
+
             # Get products documents from collection as list
-            result_docs = list(collection.find(filters))
+            result_docs = list(source.find(filters))
 
             # Convert to JSON
             result = json.loads(json.dumps(
@@ -74,16 +100,10 @@ class Products(Resource):
 
             data = request.get_json()
 
-            product_name = data['product_name']
-            product_desc = data['product_description']
-
-            # Prodduct name and description is mandatory
-            if not product_name:
-                response = generate400response(f"product_name key required.")
-                return response, 400
-
-            if not product_desc:
-                response = generate400response(f"product_name key required.")
+            # Product name and description is mandatory
+            error = prepare_product(data)
+            if error:
+                response = generate400response(error)
                 return response, 400
 
             # Insert single document from user POST body
@@ -138,6 +158,7 @@ class Products(Resource):
 
             # Pop product_id key from user request body to pass it to update query without changing product_id
             data.pop('product_id', None)
+            data[NORMALIZED_NAME_FIELD] = normalize_name(product_name)
 
             # Replace single document with user request body
             result = collection.replace_one(
@@ -159,10 +180,159 @@ class Products(Resource):
             return response, 500
 
 
+class ProductImport(Resource):
+    def post(self):
+        """RESTful POST method importing products streamed as CSV or NDJSON, one product per row"""
+        try:
+            try:
+                rows = iter_rows(request.stream, request.content_type)
+            except ValueError as error:
+                response = generate400response(str(error))
+                return response, 400
+
+            report = import_rows(collection, rows, prepare_product)
+
+            if report.database_error:
+                # Earlier chunks are already inserted, report them so the client can resume
+                return {
+                    "status": 503,
+                    "message": "Service Unavailable",
+                    "error": f"Import stopped at row {report.failed_row}, the database failed: "
+                             f"{report.database_error}. Rows from {report.failed_row} on may be partly inserted.",
+                    "timestamp": getISOtimestamp(),
+                    "failed_row": report.failed_row,
+                    "inserted_count": report.inserted_count,
+                    "error_count": report.error_count,
+                    "errors": report.errors
+                }, 503
+
+            if report.failed_row:
+                # Rows before the failed row are already inserted, report them so the client can resume
+                return {
+                    "status": 400,
+                    "message": "Bad Request",
+                    "error": f"Import stopped at row {report.failed_row}, the stream could not be read further.",
+                    "timestamp": getISOtimestamp(),
+                    "failed_row": report.failed_row,
+                    "inserted_count": report.inserted_count,
+                    "error_count": report.error_count,
+                    "errors": report.errors
+                }, 400
+
+            return {
+                "status": 201,
+                "message": "Success",
+                "timestamp": getISOtimestamp(),
+                "inserted_count": report.inserted_count,
+                "error_count": report.error_count,
+                "errors": report.errors
+            }, 201
+
+        except Exception as error:
+            response = generate500response(str(error))
+            return response, 500
+
+
+search_indexes_ready = False
+
+
+def ensure_search_indexes_ready() -> None:
+    """Creates the search indexes on first use, so they are created by the next search
+    instead of failing until a restart if the database was unreachable at startup"""
+    global search_indexes_ready
+    if not search_indexes_ready:
+        ensure_search_indexes(collection)
+        search_indexes_ready = True
+
+
+class ProductSearch(Resource):
+    def get(self):
+        """RESTful GET method searching products by relevance (mode=text) or by name prefix (mode=prefix)"""
+        try:
+            query = request.args.get('q', '').strip()
+            mode = request.args.get('mode', 'text')
+            cursor = request.args.get('cursor')
+
+            if not query:
+                response = generate400response("q query parameter required.")
+                return response, 400
+
+            if mode not in ('text', 'prefix'):
+                response = generate400response("mode must be either text or prefix.")
+                return response, 400
+
+            try:
+                limit = int(request.args.get('limit', 20))
+            except ValueError:
+                response = generate400response("limit must be of type integer.")
+                return response, 400
+
+            if limit <= 0 or limit > MAX_SEARCH_LIMIT:
+                response = generate400response(f"limit must be between 1 and {MAX_SEARCH_LIMIT}.")
+                return response, 400
+
+            ensure_search_indexes_ready()
+            search = text_search if mode == 'text' else prefix_search
+
+            try:
+                result_docs, next_cursor = search(read_collection, query, limit, cursor)
+            except ValueError as error:
+                response = generate400response(str(error))
+                return response, 400
+
+            # Convert to JSON
+            result = json.loads(json.dumps(
+                result_docs, default=json_util.default))
+
+            return {
+                "status": 200,
+                "message": "Success",
+                "timestamp": getISOtimestamp(),
+                "data": result,
+                "records_count": len(result),
+                "next_cursor": next_cursor
+            }, 200
+
+        except Exception as error:
+            res = generate500response(str(error))
+            return res, 500
+
+
+class Liveness(Resource):
+    def get(self):
+        """Liveness probe, the process is up and serving requests"""
+        return {"status": 200, "message": "Alive", "timestamp": getISOtimestamp()}, 200
+
+
+class Readiness(Resource):
+    def get(self):
+        """Readiness probe, the database is reachable"""
+        checks = {"database": ping_database()}
+        status = 200 if all(checks.values()) else 503
+
+        return {
+            "status": status,
+            "message": "Ready" if status == 200 else "Not Ready",
+            "timestamp": getISOtimestamp(),
+            "checks": checks,
+            "database": database_profile()
+        }, status
+
+
+try:
+    ensure_search_indexes_ready()
+except Exception as error:
+    logging.warning(f"Could not create search indexes: {error}")
+
 app = Flask(__name__)
 api = Api(app)
+init_compression(app)
 
 api.add_resource(Products, '/', '/<string:product_id>')
+api.add_resource(ProductSearch, '/search')
+api.add_resource(ProductImport, '/import')
+api.add_resource(Liveness, '/healthz')
+api.add_resource(Readiness, '/readyz')
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
@@ -0,0 +1,108 @@
+import base64
+import json
+import re
+import unicodedata
+
+import pymongo
+from bson import ObjectId
+
+# Field holding the normalized product name used for prefix search
+NORMALIZED_NAME_FIELD = 'product_name_normalized'
+TEXT_INDEX_NAME = 'product_text'
+
+MAX_SEARCH_LIMIT = 100
+
+
+def normalize_name(name: str) -> str:
+    """Lower cases a name, strips accents and collapses whitespace so prefixes match regardless of formatting"""
+    decomposed = unicodedata.normalize('NFKD', str(name))
+    stripped = ''.join(char for char in decomposed if not unicodedata.combining(char))
+    return ' '.join(stripped.casefold().split())
+
+
+def ensure_search_indexes(collection) -> None:
+    """Creates the text index for relevance search and the normalized name index for prefix search"""
+    collection.create_index(
+        [('product_name', pymongo.TEXT), ('product_description', pymongo.TEXT)],
+        weights={'product_name': 10, 'product_description': 1},
+        name=TEXT_INDEX_NAME
+    )
+    collection.create_index([(NORMALIZED_NAME_FIELD, pymongo.ASCENDING), ('_id', pymongo.ASCENDING)])
+
+
+def encode_cursor(values: list) -> str:
+    """Encodes the sort key of the last returned document as an opaque pagination cursor"""
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> list:
+    """Decodes a pagination cursor, raises ValueError if it is malformed"""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except Exception:
+        raise ValueError("cursor is invalid.")
+
+    if not isinstance(values, list) or len(values) != 2 or not ObjectId.is_valid(values[1]):
+        raise ValueError("cursor is invalid.")
+
+    return values
+
+
+def prefix_search(collection, query: str, limit: int, cursor: str = None) -> tuple:
+    """Returns products whose normalized name starts with the query, ordered by name, and the next cursor.
+
+    The anchored range on the normalized name is served by the (normalized name, _id) index and pagination
+    resumes after the last key instead of skipping documents.
+    """
+    prefix = normalize_name(query)
+    filters = {NORMALIZED_NAME_FIELD: {'$regex': f'^{re.escape(prefix)}'}}
+
+    if cursor:
+        last_name, last_id = decode_cursor(cursor)
+        filters = {'$and': [filters, {'$or': [
+            {NORMALIZED_NAME_FIELD: {'$gt': last_name}},
+            {NORMALIZED_NAME_FIELD: last_name, '_id': {'$gt': ObjectId(last_id)}}
+        ]}]}
+
+    docs = list(collection.find(filters)
+                .sort([(NORMALIZED_NAME_FIELD, pymongo.ASCENDING), ('_id', pymongo.ASCENDING)])
+                .limit(limit + 1))
+
+    next_cursor = None
+    if len(docs) > limit:
+        docs = docs[:limit]
+        next_cursor = encode_cursor([docs[-1][NORMALIZED_NAME_FIELD], str(docs[-1]['_id'])])
+
+    return docs, next_cursor
+
+
+def text_search(collection, query: str, limit: int, cursor: str = None) -> tuple:
+    """Returns products matching the query ranked by text relevance, and the next cursor.
+
+    Results are ordered by score then _id, the cursor resumes after the last (score, _id) pair.
+    """
+    pipeline = [
+        {'$match': {'$text': {'$search': query}}},
+        {'$addFields': {'score': {'$meta': 'textScore'}}}
+    ]
+
+    if cursor:
+        last_score, last_id = decode_cursor(cursor)
+        pipeline.append({'$match': {'$or': [
+            {'score': {'$lt': last_score}},
+            {'score': last_score, '_id': {'$gt': ObjectId(last_id)}}
+        ]}})
+
+    pipeline += [
+        {'$sort': {'score': -1, '_id': 1}},
+        {'$limit': limit + 1}
+    ]
+
+    docs = list(collection.aggregate(pipeline))
+
+    next_cursor = None
+    if len(docs) > limit:
+        docs = docs[:limit]
+        next_cursor = encode_cursor([docs[-1]['score'], str(docs[-1]['_id'])])
+
+    return docs, next_cursor